@@ -2,14 +2,29 @@
 
 
 import datetime
+import os
+import random
 import time
 
 from sd_edit_allowed import ok_to_edit
+from sd_fetch import batches, check_revisions, fetch_pages
 from sd_functions import *
 
+# Number of entries written to the edit journal in this run
+journal_state = {'entries': 0}
+# Edit scheduler: a token bucket, filled at rate edits a minute and holding up to edit_burst tokens, with one token
+# taken by each attempt to save. The rate starts at edit_rate and drops while the servers are lagged or busy
+scheduler_state = {'rate': 0.0, 'tokens': 0.0, 'updated': 0.0, 'started': 0.0, 'saved': 0}
+
+# API error codes for refusals that are worth retrying later. Other refusals (eg edit conflicts) are final
+retry_codes = ('maxlag', 'ratelimited', 'readonly')
+# Errors in reaching the servers, also worth retrying
+retry_errors = (pywikibot.exceptions.ApiTimeoutError, pywikibot.exceptions.ServerError, OSError)
+
 
 # Main function for 'edit' mode. Write the descriptions to mainspace, reading in from local staging_file
-def shortdesc_add():
+# If resume, skip the pages that an earlier run saved or skipped, as recorded in its edit_journal
+def shortdesc_add(resume=False):
     ecount = ecount_success = ecount_failure = skip_count = 0
     esuccess_str = efailure_str = ''
 
@@ -30,147 +45,122 @@ def shortdesc_add():
         print("STOPPING - can't open staging file")
         return
 
+    # The outcome for each page is recorded in the edit_journal as soon as it is known
+    entries = staged_entries(lines)
+    if resume:
+        done = read_journal()
+        if done is None:
+            print(f'STOPPING - no {edit_journal} to resume from')
+            return
+        entries = [entry for entry in entries if entry[0] not in done]
+        print(f'Resuming: {len(done)} pages already done, {len(entries)} to go')
+    try:
+        journal = open_journal(resume)
+    except:
+        print(f'STOPPING - unable to open {edit_journal}')
+        return
+
     # Work through lines of staging_file, one by one
+    # The pages are checked ahead, edit_batch_size at a time (see preflight), so the checks before each edit need no
+    # further API requests, and each edit is saved against the revision checked
+    # In assisted mode, each page is checked just before it is shown, as confirming an edit can take a while
+    # Saves are paced by the edit scheduler (see wait_for_edit_slot). Skipped lines do not wait
+    batch_size = 1 if assisted_mode else edit_batch_size
+    start_scheduler()
+    try:
+        for title, description, page, record, revid in preflight(entries, batch_size):
 
-    for line in lines:
-        # Skip line if it's a table header
-        if '{|' in line or '|}' in line or line.strip() == '':
-            continue
+            if record is None:  # Unchanged since it was staged, so already checked then
+                existing_desc, existing_type = '', None
+                if '*' in description:
+                    print(title + ' - NO EDIT MADE: Description starts with "*"')  # A page that failed staging
+                    skip_count += 1
+                    write_journal(journal, title, 'skipped', description)
+                    continue
+            else:
+                # Get existing description and type: manual or embedded
+                existing_desc, existing_type = existing_shortdesc(page)
 
-        # Set up for this page, from current line
-        values = line.split('\t')
-        title = values[1].strip()
-        description = values[2].strip()  # This is the new description we want to use
-        page = pywikibot.Page(wikipedia, title)
+                # Check for various things before allowing a page edit
+                try:
+                    if not ok_to_edit(page, title, description, username, existing_desc, existing_type, override_manual,
+                                      override_embedded, existing_desc_regex, existing_desc_required_words,
+                                      existing_desc_excluded_words):
+                        skip_count += 1
+                        write_journal(journal, title, 'skipped', description)
+                        continue   # Go on to next line, ie page to edit
+                except AssertionError:
+                    return  # Unexpected error in page title
 
-        # Get existing description and type: manual or embedded
-        existing_desc, existing_type = existing_shortdesc(page)
+            # Get manual confirmation if in assisted mode
+            if assisted_mode:
+                key_input = confirm_edit(title, existing_desc, existing_type, description)
+                if key_input == 's':
+                    break
+                if key_input != 'y':
+                    continue
 
-        # Check for various things before allowing a page edit
-        try:
-            if not ok_to_edit(page, title, description, username, existing_desc, existing_type, override_manual,
-                              override_embedded, existing_desc_regex, existing_desc_required_words,
-                              existing_desc_excluded_words):
-                skip_count += 1
-                continue   # Go on to next line, ie page to edit
-        except AssertionError:
-            return  # Unexpected error in page title
-
-        # Get manual confirmation if in assisted mode
-        if assisted_mode:
-            key_input = confirm_edit(title, existing_desc, existing_type, description)
-            if key_input == 's':
-                break
-            if key_input != 'y':
-                continue
-
-        # OK to edit at this point
-        ecount += 1
-
-        # Add a new description where none currently exists
-        if existing_type is None:
-            edit_text = 'Adding [[Wikipedia:Short description|short description]]'
-            if username == 'ShortDescBot':
-                edit_text = '[[User:ShortDescBot|ShortDescBot]] adding [[Wikipedia:Short description|short ' \
-                            'description]]'
-            page.text = '{{Short description|' + description + '}}\n' + page.text
-            print(str(ecount + 1) + ': ' + title + f' - WRITING NEW SD: ' + description)
-
-            try:
-                page.save(edit_text + ' "' + description + '"', minor=False)
-            except:
-                print(f'UNABLE TO EDIT {title}. Will retry in 1 minute')
-                time.sleep(60)
-                try:
-                    page.save(edit_text + ' "' + description + '"', minor=False)
-                except:
-                    print(f'STILL UNABLE TO EDIT {title}. Mark as failed')
-                    # Build up efailure_str string ready to log to local file
-                    efailure_str += title + '\t FAILED: ' + description + '\n'
-                    ecount -= 1
-                    ecount_failure += 1
-                else:  # OK on second attempt
-                    # Build up esuccess_str string ready to log to local file
-                    esuccess_str += title + '\t' + description + '\n'
-                    ecount_success += 1
-            else:  # Succeeded on first attempt
-                # Build up esuccess_str string ready to log to local file
-                esuccess_str += title + '\t' + description + '\n'
-                ecount_success += 1
+            # OK to edit at this point
+            ecount += 1
+            edit = {'prependtext': '{{Short description|' + description + '}}\n'}
 
-        # Override an existing embedded description
-        if existing_type == 'embedded':
-            edit_text = 'Overriding [[Wikipedia:Short description|short description]] from infobox with'
-            if username == 'ShortDescBot':
-                edit_text = '[[User:ShortDescBot|ShortDescBot]] overriding [[Wikipedia:Short description|short ' \
-                            'description]] from infobox with'
-            page.text = '{{Short description|' + description + '}}\n' + page.text
-            print(str(ecount + 1) + ': ' + title + f' - OVERRIDING EMBEDDED SD: ' + description)
-
-            try:
-                page.save(edit_text + ' "' + description + '"', minor=False)
-            except:
-                print(f'UNABLE TO EDIT {title}. Will retry in 1 minute')
-                time.sleep(60)
-                try:
-                    page.save(edit_text + ' "' + description + '"', minor=False)
-                except:
-                    print(f'STILL UNABLE TO EDIT {title}. Mark as failed')
-                    # Build up efailure_str string ready to log to local file
-                    efailure_str += title + '\t FAILED: ' + description + '\n'
-                    ecount -= 1
-                    ecount_failure += 1
-                else:  # OK on second attempt
-                    # Build up esuccess_str string ready to log to local file
-                    esuccess_str += title + '\t' + description + '\n'
-                    ecount_success += 1
-            else:  # Succeeded on first attempt
-                # Build up esuccess_str string ready to log to local file
-                esuccess_str += title + '\t' + description + '\n'
-                ecount_success += 1
+            # Add a new description where none currently exists
+            if existing_type is None:
+                edit_text = 'Adding [[Wikipedia:Short description|short description]]'
+                if username == 'ShortDescBot':
+                    edit_text = '[[User:ShortDescBot|ShortDescBot]] adding [[Wikipedia:Short description|short ' \
+                                'description]]'
+                summary = edit_text + ' "' + description + '"'
+                print(str(ecount + 1) + ': ' + title + f' - WRITING NEW SD: ' + description)
 
-        # Replace/edit a manual short description
-        if existing_type == 'manual':
-            # Construct a {{Short description}} template we know should exist, then remove it
-            sd_constructed = '{{Short description|' + existing_desc + '}}'
-            sd_constructed2 = '{{short description|' + existing_desc + '}}'
-            if sd_constructed not in page.text and sd_constructed2 not in page.text:
-                print(page.title() + ' - ERROR: Cannot locate SD template, though it should exist')
-                continue
-
-            page.text = page.text.replace(sd_constructed + '\n', '')
-            page.text = page.text.replace(sd_constructed2 + '\n', '')
-
-            edit_text = 'Changing [[Wikipedia:Short description|short description]] from'
-            if username == 'ShortDescBot':
-                edit_text = '[[User:ShortDescBot|ShortDescBot]] changing [[Wikipedia:Short description|short ' \
-                            'description]] from'
-            page.text = '{{Short description|' + description + '}}\n' + page.text
-            print(str(ecount + 1) + ': ' + title + f' - CHANGING MANUAL SD: ' + description)
-
-            try:
-                page.save(edit_text + ' "' + existing_desc + '" to "' + description + '"', minor=False)
-            except:
-                print(f'UNABLE TO EDIT {title}. Will retry in 1 minute')
-                time.sleep(60)
-                try:
-                    page.save(edit_text + ' "' + description + '"', minor=False)
-                except:
-                    print(f'STILL UNABLE TO EDIT {title}. Mark as failed')
-                    # Build up efailure_str string ready to log to local file
-                    efailure_str += title + '\t FAILED: ' + description + '\n'
-                    ecount -= 1
-                    ecount_failure += 1
-                else:  # OK on second attempt
-                    # Build up esuccess_str string ready to log to local file
-                    esuccess_str += title + '\t' + description + '\n'
-                    ecount_success += 1
-            else:  # Succeeded on first attempt
+            # Override an existing embedded description
+            elif existing_type == 'embedded':
+                edit_text = 'Overriding [[Wikipedia:Short description|short description]] from infobox with'
+                if username == 'ShortDescBot':
+                    edit_text = '[[User:ShortDescBot|ShortDescBot]] overriding [[Wikipedia:Short description|short ' \
+                                'description]] from infobox with'
+                summary = edit_text + ' "' + description + '"'
+                print(str(ecount + 1) + ': ' + title + f' - OVERRIDING EMBEDDED SD: ' + description)
+
+            # Replace/edit a manual short description
+            else:
+                # Construct a {{Short description}} template we know should exist, then remove it
+                sd_constructed = '{{Short description|' + existing_desc + '}}'
+                sd_constructed2 = '{{short description|' + existing_desc + '}}'
+                new_text = page_text(page)
+                if sd_constructed not in new_text and sd_constructed2 not in new_text:
+                    print(page.title() + ' - ERROR: Cannot locate SD template, though it should exist')
+                    write_journal(journal, title, 'skipped', description)
+                    continue
+
+                new_text = new_text.replace(sd_constructed + '\n', '')
+                new_text = new_text.replace(sd_constructed2 + '\n', '')
+
+                edit_text = 'Changing [[Wikipedia:Short description|short description]] from'
+                if username == 'ShortDescBot':
+                    edit_text = '[[User:ShortDescBot|ShortDescBot]] changing [[Wikipedia:Short description|short ' \
+                                'description]] from'
+                summary = edit_text + ' "' + existing_desc + '" to "' + description + '"'
+                edit = {'text': '{{Short description|' + description + '}}\n' + new_text}
+                print(str(ecount + 1) + ': ' + title + f' - CHANGING MANUAL SD: ' + description)
+
+            if save_edit(page, summary, revid, **edit):
                 # Build up esuccess_str string ready to log to local file
                 esuccess_str += title + '\t' + description + '\n'
+                write_journal(journal, title, 'saved', description)
                 ecount_success += 1
+            else:
+                print(f'STILL UNABLE TO EDIT {title}. Mark as failed')
+                # Build up efailure_str string ready to log to local file
+                efailure_str += title + '\t FAILED: ' + description + '\n'
+                write_journal(journal, title, 'failed', description)
+                ecount -= 1
+                ecount_failure += 1
 
-        time.sleep(wait_time)
+            invalidate_pageinfo(page)  # The saved page may now have a different description
+    finally:  # However the loop ends, the journal entries so far are pushed through to disk
+        close_journal(journal)
+    log_edit_rate()
 
     # Now write to one-off edit logging files
     print('\n')
@@ -206,3 +196,212 @@ def shortdesc_add():
         print('\nNo edit target articles found.')
 
     return
+
+
+# Open the edit_journal for appending. A new run starts a new journal, keeping any earlier one under a dated name
+def open_journal(resume):
+    if not resume and os.path.exists(edit_journal):
+        modified = datetime.datetime.fromtimestamp(os.path.getmtime(edit_journal))
+        os.replace(edit_journal, edit_journal.split('.')[0] + f' {modified:%Y-%m-%d (%H %M)}.tsv')
+    journal_state['entries'] = 0
+    return open(edit_journal, 'a', encoding='utf-8')
+
+
+# Titles of the pages saved or skipped according to the edit_journal (failures are tried again), or None if there is
+# no journal
+def read_journal():
+    if not os.path.exists(edit_journal):
+        return None
+    done = set()
+    with open(edit_journal, encoding='utf-8') as f:
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            if len(values) >= 3 and values[1] in ('saved', 'skipped'):
+                done.add(values[2])
+    return done
+
+
+# Append the outcome for a page to the journal. Each entry is flushed at once, so it survives the bot crashing, and
+# synced to disk every edit_journal_sync entries
+def write_journal(journal, title, outcome, description):
+    journal.write(f'{datetime.datetime.now():%Y-%m-%d %H:%M:%S}\t{outcome}\t{title}\t{description}\n')
+    journal.flush()
+    journal_state['entries'] += 1
+    if journal_state['entries'] % edit_journal_sync == 0:
+        os.fsync(journal.fileno())
+
+
+def close_journal(journal):
+    try:
+        journal.flush()
+        os.fsync(journal.fileno())
+    finally:
+        journal.close()
+
+
+# (title, new description, revision id, sha1) from each line of the staging file, skipping table headers and blank
+# lines. The revision id and sha1 of the page when staged are in the last two columns, or None for older staging files
+def staged_entries(lines):
+    entries = []
+    for line in lines:
+        if '{|' in line or '|}' in line or line.strip() == '':
+            continue
+        values = line.split('\t')
+        revid = sha1 = None
+        if len(values) >= 7 and values[-2].isdigit():
+            revid, sha1 = int(values[-2]), values[-1].strip()
+        entries.append((values[1].strip(), values[2].strip(), revid, sha1))  # values[2] is the new description
+    return entries
+
+
+# Check the staged pages ahead of editing, batch_size at a time. Yields (title, description, page, record, revid)
+# Pages still at the revision (or content) they were staged from, with no short description and no {{Bots}} template,
+# were checked when staged: these share one light request per batch, and have no record. Other pages (and every page
+# from a staging file without revision ids) are fetched in full, one request per batch, and come with their record
+# revid is the revision to save the edit against
+def preflight(entries, batch_size):
+    for batch in batches(entries, batch_size):
+        checks = {}
+        if any(revid for title, description, revid, sha1 in batch):
+            checks = check_revisions([title for title, description, revid, sha1 in batch])
+        pages = [pywikibot.Page(wikipedia, title) for title, description, revid, sha1 in batch]
+        unchanged = [unchanged_since_staging(checks.get(entry[0]), entry[2], entry[3]) for entry in batch]
+        stale = [page for page, same in zip(pages, unchanged) if not same]
+        records = {record['title']: record for record in fetch_pages(stale, batch_size=batch_size, categories=False)}
+        for (title, description, revid, sha1), page, same in zip(batch, pages, unchanged):
+            if same:
+                yield title, description, page, None, checks[title]['revid']
+            else:
+                record = records[page.title()]
+                yield title, description, page, record, record['revid']
+
+
+def unchanged_since_staging(check, revid, sha1):
+    if check is None or revid is None or check['missing'] or check['shortdesc'] or check['bots']:
+        return False
+    return check['revid'] == revid or (sha1 and check['sha1'] == sha1)
+
+
+# Save an edit to page: the new text, or text to add at the top (prependtext). The edit is made against revid, the
+# revision that was checked (baserevid), so that the server refuses it as an edit conflict if the page has been
+# edited since in a way that cannot be merged
+def save_page(page, summary, revid, text=None, prependtext=None):
+    params = {'action': 'edit',
+              'format': 'json',
+              'formatversion': 2,
+              'title': page.title(),
+              'summary': summary,
+              'notminor': 1,
+              'nocreate': 1,
+              'token': wikipedia.tokens['csrf']}
+    if text is not None:
+        params['text'] = text
+    else:
+        params['prependtext'] = prependtext
+    if revid:
+        params['baserevid'] = revid
+    if username == 'ShortDescBot':
+        params['bot'] = 1
+    result = api.Request(site=wikipedia, parameters=params).submit()
+    if result.get('edit', {}).get('result') != 'Success':
+        raise pywikibot.exceptions.Error(f'Edit to {page.title()} not saved: {result}')
+
+
+# Save an edit (see save_page) when the scheduler allows. Lag, rate limits and server or connection errors are retried
+# up to edit_retries times, with backoff. Returns True if the edit was saved
+def save_edit(page, summary, revid, text=None, prependtext=None):
+    for attempt in range(edit_retries + 1):
+        wait_for_edit_slot()
+        try:
+            save_page(page, summary, revid, text=text, prependtext=prependtext)
+        except pywikibot.exceptions.APIError as error:
+            if error.code not in retry_codes:
+                print(f'UNABLE TO EDIT {page.title()} ({error.code})')
+                return False
+            reason = error.code
+        except retry_errors as error:
+            reason = type(error).__name__
+        except Exception as error:
+            print(f'UNABLE TO EDIT {page.title()} ({error})')
+            return False
+        else:
+            edit_saved()
+            return True
+        slow_down(reason)
+        if attempt < edit_retries:
+            delay = backoff_delay(attempt)
+            print(f'UNABLE TO EDIT {page.title()} ({reason}). Will retry in {delay:.0f} seconds')
+            time.sleep(delay)
+    return False
+
+
+# Reset the scheduler for a run. pywikibot's put_throttle stays in force as a floor on the time between saves, so the
+# pauses pywikibot makes within a save for lag are kept even when the save then succeeds. It is measured from the last
+# save, so it adds no wait once the scheduler spaces saves further apart
+def start_scheduler():
+    now = time.monotonic()
+    scheduler_state.update(rate=float(edit_rate), tokens=float(edit_burst), updated=now, started=now, saved=0)
+    try:
+        put_rate = 60 / wikipedia.throttle.writedelay
+    except:
+        return
+    if put_rate < edit_rate:
+        print(f'WARNING: put_throttle in user-config.py limits edits to {put_rate:.1f} a minute, below edit_rate')
+
+
+# Take a token from the bucket, first waiting for one to be added if it is empty
+def wait_for_edit_slot():
+    now = time.monotonic()
+    rate = scheduler_state['rate'] / 60  # Tokens a second
+    tokens = min(edit_burst, scheduler_state['tokens'] + (now - scheduler_state['updated']) * rate)
+    if tokens < 1:
+        wait = (1 - tokens) / rate
+        time.sleep(wait)
+        now += wait
+        tokens = 1
+    scheduler_state['tokens'] = tokens - 1
+    scheduler_state['updated'] = now
+
+
+def edit_saved():
+    # A Retry-After header on a successful save means the servers are busy, so keep slowing down
+    if server_retry_after():
+        slow_down('Retry-After')
+    else:  # Recover towards edit_rate
+        scheduler_state['rate'] = min(float(edit_rate), scheduler_state['rate'] + edit_rate / 20)
+    scheduler_state['saved'] += 1
+    if scheduler_state['saved'] % 10 == 0:
+        log_edit_rate()
+
+
+# Halve the rate, down to an eighth of edit_rate, and empty the bucket
+def slow_down(reason):
+    rate = max(edit_rate / 8, scheduler_state['rate'] / 2)
+    if rate < scheduler_state['rate']:
+        print(f'{reason}: slowing edits to {rate:.1f} a minute')
+    scheduler_state['rate'] = rate
+    scheduler_state['tokens'] = min(scheduler_state['tokens'], 0.0)
+
+
+# Seconds to wait before retrying a save: edit_backoff, doubled for each earlier retry, with half of it random
+# (equal jitter), and at least as long as the server asked for
+def backoff_delay(attempt):
+    delay = edit_backoff * 2 ** attempt
+    return max(delay / 2 + random.uniform(0, delay / 2), server_retry_after())
+
+
+# The Retry-After (seconds) in the server's last response, as noted by pywikibot, or 0
+def server_retry_after():
+    try:
+        return float(wikipedia.throttle.retry_after or 0)
+    except:
+        return 0
+
+
+# Print the edits a minute achieved so far in this run, against edit_rate
+def log_edit_rate():
+    saved = scheduler_state['saved']
+    minutes = (time.monotonic() - scheduler_state['started']) / 60
+    if saved and minutes > 0:
+        print(f'EDIT RATE: {saved} edits in {minutes:.1f} minutes, {saved / minutes:.1f} a minute '
+              f'(target {edit_rate}, now {scheduler_state["rate"]:.1f})')
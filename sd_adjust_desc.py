@@ -3,7 +3,8 @@ from sd_functions import in_category
 
 
 # Add 'Extinct ...' to description unless that would make it too long
-def adjust_desc(page, lead_text, shortdesc, isextinct_autobox):
+# get_isextinct_autobox is called (only if needed) for the extinct status from any Automatictaxobox
+def adjust_desc(page, lead_text, shortdesc, get_isextinct_autobox):
     extinct_in_lead = ['is a fossil', 'is an extinct', 'was a species', 'was a genus', 'was a family', 'was a class',
                        'was an order', 'known from fossil']
     extinct_in_cat = ['fossil', 'prehistoric', 'extinctions']
@@ -11,13 +12,12 @@ def adjust_desc(page, lead_text, shortdesc, isextinct_autobox):
     if len('Extinct ' + shortdesc) > 40:
         return shortdesc
 
-    # Don't bother with more checks if we already have the answer from an Automatictaxobox
-    if isextinct_autobox:
-        return 'Extinct ' + shortdesc.lower()
-
+    # Cheapest first: the lead, then any Automatictaxobox (which may need its taxonomy template), then the categories
     for extinct in extinct_in_lead:
         if extinct in lead_text.lower():
             return 'Extinct ' + shortdesc.lower()
+    if get_isextinct_autobox():
+        return 'Extinct ' + shortdesc.lower()
     for extinct in extinct_in_cat:
         if in_category(page, extinct):
             return 'Extinct ' + shortdesc.lower()
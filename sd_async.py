@@ -0,0 +1,96 @@
+# See sd_run.py for status and copyright release information
+
+# Read-only MediaWiki API client for staging, using asyncio. Used when async_reads = True (needs the aiohttp package)
+# Requests are made from an event loop running in a background thread, so the rest of the bot stays synchronous:
+# submit() schedules a request and returns a concurrent.futures.Future, and run() waits for the answer
+# Up to async_concurrency requests are in flight at once, over a pool of kept-alive connections. Every request carries
+# maxlag, and is retried after the server's Retry-After time if the servers are lagged or overloaded
+
+import asyncio
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from sd_config import *
+
+# Event loop, its thread, the HTTP session and the semaphore limiting requests in flight. Set up on first use
+client_state = {'loop': None, 'session': None, 'semaphore': None, 'url': async_api_url}
+
+
+# Start the event loop thread and open the HTTP session
+def start_client():
+    if aiohttp is None:
+        raise ImportError('async_reads = True needs the aiohttp package (pip install aiohttp)')
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    client_state['loop'] = loop
+    asyncio.run_coroutine_threadsafe(open_session(), loop).result()
+
+
+async def open_session():
+    connector = aiohttp.TCPConnector(limit=async_concurrency, keepalive_timeout=60)
+    client_state['session'] = aiohttp.ClientSession(connector=connector, headers={'User-Agent': async_user_agent},
+                                                    timeout=aiohttp.ClientTimeout(total=async_timeout))
+    client_state['semaphore'] = asyncio.Semaphore(async_concurrency)
+
+
+# Close the HTTP session and stop the event loop
+def stop_client():
+    loop = client_state['loop']
+    if loop is None:
+        return
+    asyncio.run_coroutine_threadsafe(client_state['session'].close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    client_state.update(loop=None, session=None, semaphore=None)
+
+
+# Schedule a coroutine on the client's event loop. Returns a concurrent.futures.Future
+def submit(coro):
+    if client_state['loop'] is None:
+        start_client()
+    return asyncio.run_coroutine_threadsafe(coro, client_state['loop'])
+
+
+# Run a coroutine on the client's event loop and wait for its result
+def run(coro):
+    return submit(coro).result()
+
+
+# Make one API request (POST, so long title lists are fine) and return the decoded result. To async_api_url unless
+# another url is given. Lagged or overloaded servers are waited for, up to async_retries times
+async def api_request(params, url=None):
+    data = {'format': 'json', 'formatversion': '2', 'maxlag': str(async_maxlag)}
+    for key, value in params.items():
+        data[key] = str(value)
+    for attempt in range(async_retries):
+        async with client_state['semaphore']:
+            async with client_state['session'].post(url or client_state['url'], data=data) as response:
+                retry_after = response.headers.get('Retry-After')
+                if response.status in (429, 503):
+                    result = None
+                else:
+                    response.raise_for_status()
+                    result = await response.json(content_type=None)
+        if result is not None and 'error' not in result:
+            return result
+        if result is not None and result['error'].get('code') != 'maxlag':
+            raise RuntimeError(f"API error {result['error'].get('code')}: {result['error'].get('info')}")
+        wait = float(retry_after) if retry_after else 5 * 2 ** attempt
+        print(f'Servers lagged or busy, waiting {wait:.0f} seconds')
+        await asyncio.sleep(wait)  # Outside the semaphore, so other requests can go ahead
+    raise RuntimeError(f'API request failed after {async_retries} attempts')
+
+
+# Make a query, following continuations. Returns the list of results
+async def api_query(params, url=None):
+    params = dict(params)
+    results = []
+    while True:
+        result = await api_request(params, url)
+        results.append(result)
+        if 'continue' not in result:
+            return results
+        params.update(result['continue'])
@@ -0,0 +1,438 @@
+# See sd_run.py for status and copyright release information
+
+# Micro-benchmarks comparing current functions against the versions they replaced. Not part of the bot itself
+# Usage:
+#   python sd_bench.py rank <staged file>    rank_from_lead, on the leads in a staging tsv
+#   python sd_bench.py lead <corpus dir>     get_lead, on the page texts (*.txt) in a directory
+#   python sd_bench.py save <base file> <corpus dir>   save the texts of the pages in a base_file as a corpus
+#   python sd_bench.py generator <base file>   shortdesc_generator, on the pages in a base_file (a golden corpus)
+#   python sd_bench.py fetch <base file> <api url>   asyncio page fetching, eg from sd_standin.py, in pages/second
+
+import os
+import sys
+import time
+from statistics import multimode
+
+from sd_adjust_desc import adjust_desc
+from sd_config import *
+from sd_async import client_state, stop_client
+from sd_fetch import fetch_full_text, fetch_pages, fetch_pages_async
+from sd_functions import clean_text, find_parens, page_text, shortdesc_end, visible_categories
+from sd_generator import shortdesc_generator
+from sd_get_lead import get_lead, lead_from_text
+from sd_is_monotypic_genus import is_monotypic_genus
+from sd_parse_taxobox import parse_taxobox
+from sd_rank_from import rank_from_category, rank_from_lead, rank_from_speciesbox, rank_from_taxobox, \
+    info_from_autobox
+from sd_sources import basefile_pages
+
+
+# Previous version of rank_from_lead, kept for comparison
+def rank_from_lead_legacy(title_nobra, lead_txt, name_singular, verbose_stage):
+    regex_start1 = "(is\sa|is\san|was\sa|was\san)\s"  # eg "is a genus ..."
+    # Regex2 covers eg "is a" + <maximum of 30 chars not including 'in the'> + "genus"
+    # Need to ensure that "is an order of fungi in the class Tremellomycetes" maps to 'Order' not Class'
+    # Tempered greedy token - http://www.rexegg.com/regex-quantifiers.html#tempered_greed
+    regex_start2 = "(is\sa|are\sa|was\sa|were\sa)(?:(?!\sin\sthe).){0,50}\s"
+
+    lead_dict1 = {  # Partial strings to ensure unique matches
+        'Subgenus': regex_start1 + 'subgenu',
+        'Genus': regex_start1 + 'genus',
+        'Superfamily': regex_start1 + 'superfami',
+        'Family': regex_start1 + 'famil',
+        'Subfamily': regex_start1 + 'subfami',
+        'Tribe': regex_start1 + 'tribe',
+        'Subtribe': regex_start1 + 'subtrib',
+        'Class': regex_start1 + 'class',
+        'Subclass': regex_start1 + 'subclas',
+        'Order': regex_start1 + 'order',
+        'Suborder': regex_start1 + 'suborde',
+        'Infraorder': regex_start1 + 'infraorde',
+        'Clade': regex_start1 + 'clade',
+        'Variety': regex_start1 + 'variet',
+        'Species': regex_start1 + 'species',
+        'Informal group': regex_start1 + 'informal group',
+        'Phylum': regex_start1 + 'phylum',
+        'Subphylum': regex_start1 + 'subphylu',
+    }
+    lead_dict2 = {  # Partial strings to ensure unique matches
+        'Subgenus': regex_start2 + 'subgenu',
+        'Genus': regex_start2 + 'genus',
+        'Superfamily': regex_start2 + 'superfami',
+        'Family': regex_start2 + 'famil',
+        'Subfamily': regex_start2 + 'subfami',
+        'Tribe': regex_start2 + 'tribe',
+        'Subtribe': regex_start2 + 'subtrib',
+        'Class': regex_start2 + 'class',
+        'Subclass': regex_start2 + 'subclas',
+        'Order': regex_start2 + 'order',
+        'Suborder': regex_start2 + 'suborde',
+        'Infraorder': regex_start1 + 'infraorde',
+        'Clade': regex_start2 + 'clade',
+        'Variety': regex_start2 + 'variet',
+        'Species': regex_start2 + 'species',
+        'Informal group': regex_start2 + 'informal group',
+        'Phylum': regex_start1 + 'phylum',
+        'Subphylum': regex_start1 + 'subphylu',
+    }
+    rank = None
+
+    # For this function only, just consider the first sentence
+    lead_sen = lead_txt.split('.')[0]
+    if len(lead_sen) > 26:  # Don't do this if first sentence is unreasonably short
+        lead_txt = lead_sen
+
+    # Pre-filter with tight regex of lead_dict1 to extract any obvious match before attempting anything clever
+    for key, val in lead_dict1.items():
+        if re.search(val, lead_txt):  # eg "is a genus ..."
+            rank = key
+            if verbose_stage:
+                print('lead_dict1 lead rank is ', rank)
+            return rank
+
+    # Must be Species if lead has eg "Abacetus alesi is a beetle ..."
+    try:
+        regex_sp1 = f'{title_nobra}\s(is\sa|is\san|was\sa|was\san)\s{name_singular}'
+        if re.search(regex_sp1, lead_txt):
+            if verbose_stage:
+                print('regex_sp1 lead match on Species')
+            return 'Species'
+    except re.error:  # Fails if title includes a question mark
+        pass
+
+    # Most probably Species if lead has eg " ... is a beetle ..."
+    regex_sp2 = f"(is\sa|is\san|was\sa|was\san)\s{name_singular}"
+    if re.search(regex_sp2, lead_txt):
+        if verbose_stage:
+            print('regex_sp2 lead match on Species')
+        return 'Species'
+
+    # Work through the options with looser regex of lead_dict2. Return if exactly one rank matches, otherwise None
+    matched = False
+    for key, val in lead_dict2.items():
+        if re.search(val, lead_txt):
+            if verbose_stage:
+                print('lead_dict2 lead matches on ', key)
+            if matched:
+                return None
+            rank = key
+            matched = True
+
+    return rank
+
+
+# Previous version of get_lead (taking the page text), kept for comparison
+def get_lead_legacy(text):
+    sections = pywikibot.textlib.extract_sections(text, wikipedia)
+    lead = sections[0]
+    # Remove any templates: {{ ... }}
+    # First, replace template double braces with single so we can use find_parens
+    try:
+        lead = lead.replace("{{", "{")
+        lead = lead.replace("}}", "}")
+        result = find_parens(lead, '{', '}')  # Get start and end indexes for all templates
+        # Go through templates and replace with ` strings of same length, to avoid changing index positions
+        for key in result:
+            start = key
+            end = result[key]
+            length = end - start + 1
+            lead = lead.replace(lead[start:end + 1], "`" * length)
+    except IndexError:
+        pass
+
+    # Deal with piped wikilinks: replace [[xxx|yyy]] with [[yyy]]
+    lead = re.sub(r"\[([^\]\[|]*)\|", "[", lead, re.MULTILINE)
+
+    # Remove any images: [[File: ... ]] or [[Image: ... ]]
+    # Replace double square brackets with single so we can use find_parens
+    try:
+        lead = lead.replace("[[", "[")
+        lead = lead.replace("]]", "]")
+        result = find_parens(lead, '[', ']')  # Get start and end indexes for all square brackets
+        # Go through results and replace wikicode representing images with ` strings of same length
+        for key in result:
+            start = key
+            end = result[key]
+            strstart = lead[start + 1:start + 7]
+            if 'File:' in strstart or 'Image:' in strstart:
+                length = end - start + 1
+                lead = lead.replace(lead[start:end + 1], "`" * length)
+    except IndexError:
+        pass
+
+    # Remove re-used refs such as <ref name = "Name" / >
+    lead = re.sub("<ref.{1,40}\/\s{0,3}>", "", lead, re.MULTILINE)
+
+    # Replace "<ref" and "ref>" with sentinels ! and ~ so we can use find_parens
+    try:
+        lead = lead.replace("<ref", "!")
+        lead = lead.replace("ref>", "~")
+        lead = lead.replace("ref >", "~")
+        # # Go through templates and replace with ` strings of same length
+        result = find_parens(lead, '!', '~')  # Get start and end indexes for sentinels
+        for key in result:
+            start = key
+            end = result[key]
+            length = end - start + 1
+            lead = lead.replace(lead[start:end + 1], "`" * length)
+    except:  # (Don't know why, but need to reverse the replacements here)
+        lead = lead.replace("!", "<ref")
+        lead = lead.replace("~", "ref>")
+
+    # Delete the temporary ` strings and clean up
+    try:
+        lead = clean_text(lead)  # (includes removal of remaining '[' and ']')
+        lead = lead[:150].strip()
+    except:
+        pass
+
+    return lead
+
+
+# Previous version of shortdesc_generator, which evaluated every rank source up front, kept for comparison
+def shortdesc_generator_eager(page, lead_text):
+    #  Make compressed searchable version of page text
+    text_compressed = page_text(page).lower().replace(' ', '')
+    taxobox = parse_taxobox(text_compressed)  # Taxobox parameters, from one pass over the text
+
+    # Get title, ignoring brackets
+    title = page.title()
+    title_nobra = re.sub(r'\(.+?\)', '', title).strip()
+    single_word_title = True if len(title_nobra.split()) == 1 else False
+
+    rank_category = rank_from_category(page)
+    rank_lead = rank_from_lead(title_nobra, lead_text, name_singular, verbose_stage)
+    rank_speciesbox = rank_from_speciesbox(taxobox)
+    rank_taxobox = rank_from_taxobox(title_nobra, taxobox)
+    rank_autobox, isextinct_autobox = info_from_autobox(wikipedia, text_compressed)
+    all_ranks = [rank_category, rank_lead, rank_speciesbox, rank_taxobox, rank_autobox]
+
+    # Must be Variety or Subspecies if so noted in title
+    if 'var.' in title:
+        best_rank = 'Variety'
+        shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_singular)
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+    if 'subsp.' in title:
+        best_rank = 'Subspecies'
+        shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_singular)
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+    if 'sect.' in title:
+        best_rank = 'Group'
+        shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_plural)
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+    if 'subg.' in title:
+        best_rank = 'Subgenus'
+        shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_plural)
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+    if ' sp.' in title:
+        best_rank = 'Species'
+        shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_singular)
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+
+    # Get the most common rank from the list (excluding None)
+    all_ranks_xnone = [x for x in all_ranks if x is not None]
+    best_ranks = multimode(all_ranks_xnone)  # List of most common ranks (eg a list of 2 if there is a tie)
+    best_rank = ''
+    if len(best_ranks) == 1:
+        best_rank = best_ranks[0]  # The single best rank, if there is one
+
+    if verbose_stage:
+        print('rank_category, rank_lead, rank_speciesbox, rank_taxobox, rank_autobox')
+        print(all_ranks)
+        print(all_ranks_xnone)
+        print('best_ranks: ', best_ranks, 'Best rank: ', best_rank)
+
+    # Deal with situation where a single best rank has been identified
+    if best_rank:
+
+        if single_word_title:  # Species is unexpected if single-word title; but may be monotypic genus
+            if best_rank == 'Species' and is_monotypic_genus(text_compressed, lead_text, visible_categories(page)):
+                best_rank = 'Genus'
+                shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_plural)
+                return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+            if best_rank in ['Subspecies', 'Variety']:  # Subspecies/variety is unexpected if single-word title
+                shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_singular)
+                return False, '*** : ' + adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+
+        if not single_word_title:  # Genus or higher rank unexpected if multi-word title
+            if best_rank not in ('Species', 'Subspecies', 'Variety'):
+                shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_plural)
+                return False, '*** : ' + adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+
+        shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_plural)  # Best rank looks good
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+
+    # Return False if nothing at all works
+    diff_ranks = list(set(all_ranks_xnone))
+    if not diff_ranks:
+        return False, "***** : NO MATCHING RANKS"
+
+    # At this point we have several conflicting ranks for this page
+
+    # Exceptions for Genus/Species: single-word titles classified as species are normally monotypic genus articles
+    # Single-word titles are very rarely species
+    if 'Genus' in diff_ranks and 'Species' in diff_ranks:
+        if not single_word_title:
+            shortdesc = 'Species' + ' of ' + name_singular
+        if single_word_title:
+            shortdesc = 'Genus' + ' of ' + name_plural
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+
+    # Prefer subspecies/variety to species
+    if 'Subspecies' in diff_ranks and 'Species' in diff_ranks:
+        shortdesc = 'Subspecies' + ' of ' + name_singular
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+    if 'Variety' in diff_ranks and 'Species' in diff_ranks:
+        shortdesc = 'Variety' + ' of ' + name_singular
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+
+    # Accept Species if a two-word title and at least one other possibility matches
+    if 'Species' in diff_ranks and len(title_nobra.split()) == 2:
+        if verbose_stage:
+            print('Two-word title and at least one match to Species')
+        shortdesc = 'Species' + ' of ' + name_singular
+        return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+
+    # Drop inconsistent_automatictaxobox rank, and check if there is a new best one. Then return with that
+    if rank_autobox is not None:
+        best_ranks.remove(rank_autobox)
+        if len(best_ranks) == 1:
+            best_rank = best_ranks[0]  # The single best rank, if there is one
+            shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_plural)
+            if verbose_stage:
+                print(f'Overriding automatictaxobox rank: ', rank_autobox)
+                print('New best_ranks: ', best_ranks, 'New best_rank: ', best_rank)
+            return True, adjust_desc(page, lead_text, shortdesc, lambda: isextinct_autobox)
+
+    # Failed: return with some useful error text
+    if rank_autobox is not None:
+        return False, f'***** :  AUTOTAXOBOX HAS {rank_autobox}'
+
+    return False, "***** : CAN'T GET BEST RANK"
+
+
+# Read (title, lead) pairs from a staging tsv file
+def read_lead_corpus(staged_file):
+    corpus = []
+    with open(staged_file, encoding='utf-8') as f:
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            if len(values) >= 5:
+                title_nobra = re.sub(r'\(.+?\)', '', values[1]).strip()
+                corpus.append((title_nobra, values[4]))
+    return corpus
+
+
+# Time f over the corpus, repeats times, and return the best total in seconds
+def time_over_corpus(f, corpus, repeats=5):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for args in corpus:
+            f(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# Check rank_from_lead gives the same ranks as before, and compare timings
+def bench_rank_from_lead(staged_file):
+    corpus = [(title_nobra, lead, name_singular, False) for title_nobra, lead in read_lead_corpus(staged_file)]
+    mismatches = 0
+    for title_nobra, lead, _, _ in corpus:
+        old = rank_from_lead_legacy(title_nobra, lead, name_singular, False)
+        new = rank_from_lead(title_nobra, lead, name_singular, False)
+        if old != new:
+            mismatches += 1
+            print(f'MISMATCH {title_nobra}: {old} -> {new}')
+    t_old = time_over_corpus(rank_from_lead_legacy, corpus)
+    t_new = time_over_corpus(rank_from_lead, corpus)
+    print(f'rank_from_lead: {len(corpus)} leads, {mismatches} mismatches')
+    print(f'  previous: {1e6 * t_old / max(len(corpus), 1):.1f} us/lead   current: '
+          f'{1e6 * t_new / max(len(corpus), 1):.1f} us/lead   ({t_old / t_new:.2f}x)')
+
+
+# Save the text of every page listed in a base_file (Petscan tsv) as <corpus dir>/<n>.txt
+def save_text_corpus(titles_file, corpus_dir):
+    os.makedirs(corpus_dir, exist_ok=True)
+    pages = (page for cursor, page in basefile_pages(titles_file))
+    for n, record in enumerate(fetch_pages(pages)):
+        with open(os.path.join(corpus_dir, f'{n}.txt'), 'w', encoding='utf-8') as f:
+            f.write(record['text'])
+
+
+# Check get_lead gives byte-identical leads to before on a corpus of page texts, and compare timings
+def bench_get_lead(corpus_dir):
+    corpus = []
+    for name in sorted(os.listdir(corpus_dir)):
+        if name.endswith('.txt'):
+            with open(os.path.join(corpus_dir, name), encoding='utf-8') as f:
+                corpus.append((f.read(),))
+    mismatches = 0
+    for text, in corpus:
+        old = get_lead_legacy(text)
+        new = lead_from_text(text)
+        if old != new:
+            mismatches += 1
+            print(f'MISMATCH:\n  {old!r}\n  {new!r}')
+    t_old = time_over_corpus(get_lead_legacy, corpus, 3)
+    t_new = time_over_corpus(lead_from_text, corpus, 3)
+    print(f'get_lead: {len(corpus)} pages, {mismatches} mismatches')
+    print(f'  previous: {1e3 * t_old / max(len(corpus), 1):.2f} ms/page   current: '
+          f'{1e3 * t_new / max(len(corpus), 1):.2f} ms/page   ({t_old / t_new:.2f}x)')
+
+
+# Check shortdesc_generator gives the same results as before on the pages listed in a base_file (Petscan tsv), and
+# compare timings. Needs live API access
+def check_generator(titles_file):
+    pages = (page for cursor, page in basefile_pages(titles_file))
+    count = mismatches = 0
+    t_old = t_new = 0.0
+    for record in fetch_pages(pages, lead_only=fetch_lead_only):
+        page = record['page']
+        if record['missing']:
+            continue
+        lead_text = get_lead(page)
+        if not lead_text and record['lead_only']:
+            fetch_full_text(record)
+            lead_text = get_lead(page)
+        if not lead_text:
+            continue
+        count += 1
+        start = time.perf_counter()
+        old = shortdesc_generator_eager(page, lead_text)
+        t_old += time.perf_counter() - start
+        start = time.perf_counter()
+        new = shortdesc_generator(page, lead_text)
+        t_new += time.perf_counter() - start
+        if old != new:
+            mismatches += 1
+            print(f'MISMATCH: {page.title()}\n  {old!r}\n  {new!r}')
+    print(f'shortdesc_generator: {count} pages, {mismatches} mismatches')
+    print(f'  previous: {1e3 * t_old / max(count, 1):.2f} ms/page   current: '
+          f'{1e3 * t_new / max(count, 1):.2f} ms/page')
+
+
+# Time fetching the pages in a base_file with the asyncio client, from the API at api_url (eg a stand-in on loopback)
+def bench_fetch(titles_file, api_url):
+    client_state['url'] = api_url
+    pages = [page for cursor, page in basefile_pages(titles_file)]
+    start = time.perf_counter()
+    count = sum(1 for record in fetch_pages_async(pages, lead_only=fetch_lead_only))
+    elapsed = time.perf_counter() - start
+    stop_client()
+    print(f'fetch: {count} pages in {elapsed:.2f} s ({count / elapsed:.0f} pages/s), '
+          f'{async_concurrency} requests in flight')
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'rank':
+        bench_rank_from_lead(sys.argv[2])
+    elif sys.argv[1] == 'lead':
+        bench_get_lead(sys.argv[2])
+    elif sys.argv[1] == 'save':
+        save_text_corpus(sys.argv[2], sys.argv[3])
+    elif sys.argv[1] == 'generator':
+        check_generator(sys.argv[2])
+    elif sys.argv[1] == 'fetch':
+        bench_fetch(sys.argv[2], sys.argv[3])
@@ -0,0 +1,111 @@
+# See sd_run.py for status and copyright release information
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pywikibot.data import api
+
+from sd_config import *
+
+
+# Get the articles and subcategories of a category, following continuations. Returns (pages, subcats) as title lists
+def category_members(site, cat_title, recurse):
+    params = {'action': 'query',
+              'format': 'json',
+              'formatversion': 2,
+              'list': 'categorymembers',
+              'cmtitle': cat_title,
+              'cmnamespace': '0|14' if recurse else '0',
+              'cmprop': 'title',
+              'cmlimit': 'max'}
+    pages = []
+    subcats = []
+    while True:
+        result = api.Request(site=site, parameters=params).submit()
+        for item in result['query']['categorymembers']:
+            if item['ns'] == 14:
+                subcats.append(item['title'])
+            else:
+                pages.append(item['title'])
+        if 'continue' not in result:
+            break
+        params.update(result['continue'])
+    return pages, subcats
+
+
+# Walk the category tree below cat_title breadth first, one level at a time, with up to category_threads categories
+# being fetched at once. Each category is visited once, so cycles are harmless. The walk stops at category_max_depth
+# levels of subcategories, or once category_max_pages articles (if not 0) have been found
+# Returns the tree as a dict: 'subcats' maps each category visited to its subcategories, and 'members' lists the
+# articles found, each once, in the order they were reached
+def walk_category_tree(site, cat_title, recurse):
+    subcats = {}
+    members = []
+    seen_pages = set()
+    seen_cats = {cat_title}
+    level = [cat_title]
+    depth = 0
+    complete = True
+    with ThreadPoolExecutor(max_workers=category_threads) as pool:
+        while level:
+            print(f'Category tree: {len(level)} categories at depth {depth} ({len(members)} articles so far)')
+            results = pool.map(lambda cat: category_members(site, cat, recurse), level)
+            next_level = []
+            for cat, (pages, cats) in zip(level, results):
+                subcats[cat] = cats
+                for title in pages:
+                    if title not in seen_pages:
+                        seen_pages.add(title)
+                        members.append(title)
+                for sub in cats:
+                    if sub in seen_cats:
+                        continue
+                    if depth >= category_max_depth:
+                        complete = False
+                        continue
+                    seen_cats.add(sub)
+                    next_level.append(sub)
+            if category_max_pages and len(members) >= category_max_pages:
+                if len(members) > category_max_pages or next_level:
+                    complete = False
+                del members[category_max_pages:]
+                break
+            level = next_level
+            depth += 1
+    if not complete:
+        print(f'WARNING: Category tree under {cat_title} was cut short at depth {category_max_depth} or '
+              f'{category_max_pages} articles')
+    return {'root': cat_title, 'recurse': recurse, 'walked': time.time(), 'complete': complete, 'subcats': subcats,
+            'members': members}
+
+
+# Where the tree for cat_title is kept
+def category_tree_file(cat_title):
+    return category_tree_prefix + re.sub(r'[\\/:*?"<>|]', '_', cat_title) + '.json'
+
+
+# The category tree for cat_title: from disk if there is a saved copy (less than category_tree_days old, unless
+# any_age), otherwise walked afresh and saved
+def get_category_tree(site, cat_title, recurse, any_age=False):
+    filename = category_tree_file(cat_title)
+    if os.path.exists(filename):
+        try:
+            with open(filename, encoding='utf-8') as f:
+                tree = json.load(f)
+            age_days = (time.time() - tree['walked']) / 86400
+            if tree['recurse'] == recurse and (any_age or age_days < category_tree_days):
+                print(f'Using saved category tree {filename} ({len(tree["members"])} articles, '
+                      f'{age_days:.1f} days old)')
+                return tree
+        except:
+            print(f'WARNING: Unable to read {filename}')
+    tree = walk_category_tree(site, cat_title, recurse)
+    try:
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(tree, f)
+        os.replace(filename + '.tmp', filename)
+    except:
+        print(f'WARNING: Unable to write {filename}')
+    return tree
@@ -0,0 +1,147 @@
+# See sd_run.py for status and copyright release information
+
+# Offline index of the visible categories of every page, built from the database dumps, so that the category checks
+# (in_category, as used by rank_from_category and adjust_desc) need no API requests. Set category_index in sd_config.py
+# The index is a single binary file, read through mmap: the page ids in order, for each page the ids of its visible
+# categories (sorted), and a table of category titles that the ids index. Hidden categories are left out
+# Built from the categorylinks table as laid out with cl_to (cl_from, cl_to, cl_sortkey, cl_timestamp,
+# cl_sortkey_prefix, cl_collation, cl_type), which is in page id order. Needs about 4 bytes of memory per category link
+# A dump in the newer layout (cl_target_id, with titles in the linktarget table) is refused, rather than giving an
+# empty index
+# Usage:
+#   python sd_catindex.py <page.sql.gz> <page_props.sql.gz> <categorylinks.sql.gz>
+
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+from sd_config import *
+from sd_props import page_row_regex, props_row_regex, sql_rows, sql_unescape
+
+# The mapped index, opened on first use, and the lower-cased category titles decoded from it so far, keyed by id
+catindex_state = {'data': None, 'failed': False, 'names': {}}
+
+catindex_magic = b'SDCATIX1'
+catindex_header = struct.Struct('<8sIIII')  # Magic, then the numbers of pages, links, categories and title bytes
+# A row of the categorylinks table: cl_from, cl_to, then four more quoted values (skipped), then cl_type
+catlinks_row_regex = re.compile(r"\((\d+),'((?:[^'\\]|\\.)*)',(?:'(?:[^'\\]|\\.)*',){4}'(page|subcat|file)'\)")
+any_row_regex = re.compile(r'\(')  # The start of any row
+
+
+# Build the index from the page, page_props and categorylinks dumps. Written to a temporary file that replaces
+# index_file when complete
+def build_catindex(index_file, page_file, props_file, links_file):
+    start = time.time()
+    print(f'Reading {props_file}')
+    hidden_ids = {int(pageid) for pageid, name, value in sql_rows(props_file, props_row_regex) if name == 'hiddencat'}
+    print(f'Reading {page_file}')
+    hidden = {sql_unescape(title) for pageid, ns, title in sql_rows(page_file, page_row_regex)
+              if ns == '14' and int(pageid) in hidden_ids}
+    print(f'{len(hidden)} hidden categories')
+
+    # Category links, grouped by page. Categories are numbered in the order they are first seen, for now
+    print(f'Reading {links_file}')
+    pageids = array('I')
+    starts = array('I')
+    links = array('I')
+    cat_ids = {}
+    last = 0
+    rows = 0
+    for pageid, cat, cl_type in sql_rows(links_file, catlinks_row_regex):
+        rows += 1
+        if cl_type != 'page':  # Subcategories and files
+            continue
+        pageid = int(pageid)
+        if pageid != last:
+            if pageid < last:
+                raise ValueError(f'{links_file} is not in page id order')
+            pageids.append(pageid)
+            starts.append(len(links))
+            last = pageid
+        cat = sql_unescape(cat)
+        if cat not in hidden:
+            links.append(cat_ids.setdefault(cat, len(cat_ids)))
+    if not rows and any(True for row in sql_rows(links_file, any_row_regex)):
+        raise ValueError(f'No rows of {links_file} have the expected layout (cl_from, cl_to, ..., cl_type). Newer '
+                         f'dumps, with cl_target_id in place of cl_to, are not supported')
+    starts.append(len(links))
+    print(f'{len(links)} visible category links on {len(pageids)} pages')
+
+    # Renumber the categories in title order, and sort each page's categories
+    names = sorted(cat_ids)
+    renumber = array('I', bytes(4 * len(names)))
+    for cat_id, name in enumerate(names):
+        renumber[cat_ids[name]] = cat_id
+    for i in range(len(pageids)):
+        links[starts[i]:starts[i + 1]] = array('I', sorted(renumber[cat] for cat in links[starts[i]:starts[i + 1]]))
+    titles = bytearray()
+    title_starts = array('I')
+    for name in names:
+        title_starts.append(len(titles))
+        titles += ('Category:' + name.replace('_', ' ')).encode('utf-8')
+    title_starts.append(len(titles))
+
+    with open(index_file + '.tmp', 'wb') as f:
+        f.write(catindex_header.pack(catindex_magic, len(pageids), len(links), len(names), len(titles)))
+        for part in (pageids, starts, links, title_starts):
+            part.tofile(f)
+        f.write(titles)
+    os.replace(index_file + '.tmp', index_file)
+    print(f'Index of {len(pageids)} pages and {len(names)} categories written to {index_file} in '
+          f'{time.time() - start:.0f} seconds')
+
+
+# Map the category_index into memory, and set up views of its arrays
+def open_catindex():
+    try:
+        f = open(category_index, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        magic, pages, links, cats, title_bytes = catindex_header.unpack_from(data)
+        if magic != catindex_magic:
+            raise ValueError
+    except:
+        print(f'WARNING: Unable to read {category_index}. Looking up categories live instead')
+        catindex_state['failed'] = True
+        return
+    view = memoryview(data)
+    offset = catindex_header.size
+    for key, count in (('pageids', pages), ('starts', pages + 1), ('links', links), ('title_starts', cats + 1)):
+        catindex_state[key] = view[offset:offset + 4 * count].cast('I')
+        offset += 4 * count
+    catindex_state['titles'] = view[offset:offset + title_bytes]
+    catindex_state['data'] = data
+
+
+# Lower-cased titles of the visible categories of the page with this page id, as in visible_categories, or None if
+# the page is not in the category_index
+def indexed_categories(pageid):
+    if catindex_state['data'] is None and not catindex_state['failed']:
+        open_catindex()
+    if catindex_state['failed']:
+        return None
+    pageids = catindex_state['pageids']
+    i = bisect.bisect_left(pageids, pageid)
+    if i == len(pageids) or pageids[i] != pageid:
+        return None
+    starts = catindex_state['starts']
+    title_starts = catindex_state['title_starts']
+    names = catindex_state['names']
+    cats = []
+    for cat_id in catindex_state['links'][starts[i]:starts[i + 1]]:
+        if cat_id not in names:
+            title = catindex_state['titles'][title_starts[cat_id]:title_starts[cat_id + 1]]
+            names[cat_id] = bytes(title).decode('utf-8').lower()
+        cats.append(names[cat_id])
+    return frozenset(cats)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('Usage: python sd_catindex.py <page.sql.gz> <page_props.sql.gz> <categorylinks.sql.gz>')
+        sys.exit(1)
+    build_catindex(category_index or 'category index.bin', sys.argv[1], sys.argv[2], sys.argv[3])
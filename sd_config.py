@@ -35,7 +35,32 @@ use_basefile = True
 base_file = f'base_file {name_plural}.tsv'
 # (2) Or, read directly from a WP Category. Does this unless use_basefile = True
 targetcat = ''
-recurse_cats = True  # Be careful with this!
+recurse_cats = True  # Be careful with this! The walk is limited by category_max_depth and category_max_pages
+category_max_depth = 10  # Levels of subcategories below targetcat
+category_max_pages = 500000  # Set to 0 for no limit
+category_threads = 4  # Categories fetched at once while walking the tree
+# The walked tree and its articles are saved, and reused by later runs on the same targetcat for category_tree_days
+category_tree_prefix = 'category tree '
+category_tree_days = 7
+# (3) Or, read the pages offline from a local pages-articles XML dump (.xml or .xml.bz2). Does this if use_dump = True
+# Stages the dump's articles with titles in the base_file, or (if dump_title_regex is set) those matching the regex
+# The dump has no Wikidata descriptions, and only manual short descriptions and directly-linked categories are seen
+use_dump = False
+dump_file = 'enwiki-latest-pages-articles.xml.bz2'
+dump_title_regex = None  # eg re.compile(r'^[A-Z][a-z]+ [a-z]+$'), or None to use the base_file titles
+dump_decompressor = ''  # eg 'lbzip2' or 'pbzip2' to decompress on several cores. '' uses Python's bz2 module
+# Redirects in the input are skipped. Set True to stage their target articles instead
+follow_redirects = False
+# Number of pages fetched per API request (text, pageprops, categories and Wikidata item together). Max 50
+fetch_batch_size = 50
+# Fetch only section 0 (the lead, which includes the infobox) when staging, instead of the full page text
+# Pages whose lead cannot be extracted from section 0 are re-fetched in full
+fetch_lead_only = True
+# Look up each page's Wikidata description (for reference only, in the staging file). Set False to skip Wikidata
+use_wikidata = True
+# Offline index of the visible categories of every page (built by 'python sd_catindex.py', see there). When set, page
+# categories are read from it instead of being fetched with the pages. Pages not in it are looked up live
+category_index = ''  # eg 'category index.bin'
 
 # Define the pages that that we intend to stage. Others will be skipped without comment
 require_infobox = False
@@ -53,10 +78,33 @@ text_regex = re.compile(r'', re.IGNORECASE)
 title_regex_tf = False  # Check for this regex in the page title
 title_regex = re.compile(r'', re.IGNORECASE)
 
+# Local store of Template:Taxonomy rank and extinct status, used for pages with an Automatic taxobox
+# Set refresh_taxonomy = True to fill it (or bring it up to date) in bulk before staging
+taxonomy_store = 'taxonomy store.json'
+refresh_taxonomy = False
+
+# Read pages and taxonomy templates with the asyncio API client (needs the aiohttp package), with up to
+# async_concurrency requests in flight. Editing always goes through Pywikibot
+async_reads = False
+async_api_url = 'https://en.wikipedia.org/w/api.php'
+async_wikidata_url = 'https://www.wikidata.org/w/api.php'  # For Wikidata descriptions
+async_concurrency = 4
+async_maxlag = 5  # Seconds. Requests are retried (up to async_retries times) while the servers are more lagged
+async_retries = 6
+async_timeout = 120  # Seconds per request
+async_user_agent = 'ShortDescBot (https://en.wikipedia.org/wiki/User:ShortDescBot)'
+
+# Classify pages in this many worker processes while the main process fetches pages. Set to 0 to do it all in one
+stage_processes = 0
+stage_queue_size = 200  # Maximum pages fetched but not yet written, when using worker processes
+
 # Staging output
 stage_to_file = True  # Stage to file?
 max_stage = 0  # Set to 0 for no limit
 staging_file = f'staged {name_plural}.tsv'  # (date is added for staging_file output)
+staging_flush_rows = 100  # Staged rows are flushed to disk after every staging_flush_rows rows
+# Where to resume an unfinished staging run from (saved every staging_flush_rows pages). Use 'python sd_run.py --resume'
+staging_checkpoint = 'staging checkpoint.json'
 write_wp_examples = False  # Write some examples to my wp userspace, for community review
 wp_examples_page = 'User:MichaelMaggs/ShortDesc'
 max_examples = 200
@@ -69,6 +117,10 @@ override_embedded = False  # Existing description embedded within eg an infobox
 # Allow change to existing description only when matched
 existing_desc_required_words = ['']
 existing_desc_excluded_words = []
+# Offline index of articles that already have a short description (built by 'python sd_props.py', see there). When set,
+# staging drops targets listed in it before fetching them, as allowed by override_manual and override_embedded
+# Articles not in the index are checked live as usual. '' to check every target live
+shortdesc_index = ''  # eg 'shortdesc index.sqlite'
 
 # existing_desc_regex = re.compile('(Extinct\s|)(genus|species|family|clade|order)\sof\sreptile', re.IGNORECASE)
 existing_desc_regex = re.compile('', re.IGNORECASE)  # If null is wanted, remember to include that
@@ -78,8 +130,22 @@ existing_desc_regex = re.compile('', re.IGNORECASE)  # If null is wanted, rememb
 # assisted_mode: set to True to step though and confirm every live edit in advance
 # If before BAG approval, must run from normal user account, not the bot account,
 assisted_mode = False
-# Set a longer than usual wait time between live wp edits. Normally controlled by put_throttle in user-config.py
-wait_time = 0
+# Live edits are paced at edit_rate edits a minute on average, with bursts of up to edit_burst edits. put_throttle in
+# user-config.py still sets the shortest time between edits, so keep it at or below 60 / edit_rate seconds. The rate
+# is halved while the servers report lag or rate limits, and recovers as edits succeed. A failed save is retried up to
+# edit_retries times, waiting edit_backoff seconds (doubled at each retry, with jitter, and never less than the
+# server's Retry-After) in between. Lines that are skipped are not paced
+edit_rate = 10
+edit_burst = 1
+edit_retries = 2
+edit_backoff = 60
+# Staged pages are fetched and checked ahead of editing, this many per API request (max 50). One at a time if assisted
+edit_batch_size = 50
+# The outcome for each page (saved, skipped or failed) is appended to edit_journal as it happens, and synced to disk
+# every edit_journal_sync entries. 'python sd_run.py --resume' carries on after an interrupted run, without rechecking
+# the pages it saved or skipped
+edit_journal = 'edit journal.tsv'
+edit_journal_sync = 20
 
 # INITIALISE
 
@@ -0,0 +1,167 @@
+# See sd_run.py for status and copyright release information
+
+# Offline staging source: pages read from a local pages-articles XML dump (.xml or .xml.bz2) instead of the API
+# The dump is streamed through an incremental parser, and each page's elements are discarded once it has been read,
+# so memory use does not grow with the size of the dump. Set dump_decompressor (eg 'lbzip2' or 'pbzip2') to
+# decompress on several cores in a separate process
+# Staging from a dump makes no API requests: the dump's Template:Taxonomy pages are read into the taxonomy store
+# first (see scan_dump_taxonomy), and taxa that are still missing are not looked up
+
+import bz2
+import hashlib
+import os
+import subprocess
+import xml.etree.ElementTree as ElementTree
+
+from sd_config import *
+from sd_fetch import fetched
+from sd_sources import basefile_titles
+from sd_taxonomy import load_taxonomy_store, parse_taxonomy, save_taxonomy_store, taxonomy, taxonomy_state
+
+# Record of the page last passed on by dump_pages, until taken by dump_fetch, keyed by title
+dump_records = {}
+
+manual_shortdesc_regex = re.compile(r'\{\{\s*[Ss]hort description\s*\|\s*([^|}]*?)\s*[|}]')
+category_link_regex = re.compile(r'\[\[\s*[Cc]ategory\s*:\s*([^|\]\n]+?)\s*[|\]]')
+
+
+# Open the dump as a binary stream of XML. Returns (stream, decompressor process or None)
+def open_dump(dump_file):
+    if dump_file.endswith('.bz2'):
+        if dump_decompressor:
+            process = subprocess.Popen([dump_decompressor, '-dc', dump_file], stdout=subprocess.PIPE,
+                                       bufsize=1024 * 1024)
+            return process.stdout, process
+        return bz2.open(dump_file, 'rb'), None
+    return open(dump_file, 'rb'), None
+
+
+# Yield (title, ns, pageid, revid, is_redirect, text) for every page in the dump. Skips the first skip pages quickly
+# If the dump_decompressor fails, the dump may look complete but be cut short, so that raises an error at the end
+def read_dump(dump_file, skip=0):
+    stream, process = open_dump(dump_file)
+    finished = False
+    try:
+        root = None
+        count = 0
+        for event, elem in ElementTree.iterparse(stream, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end' or elem.tag.rsplit('}', 1)[-1] != 'page':
+                continue
+            count += 1
+            if count > skip:
+                yield elem.findtext('{*}title'), int(elem.findtext('{*}ns')), int(elem.findtext('{*}id')), \
+                    int(elem.findtext('{*}revision/{*}id') or 0), elem.find('{*}redirect') is not None, \
+                    elem.findtext('{*}revision/{*}text') or ''
+            root.clear()  # Discard the pages read so far
+        finished = True
+    finally:
+        stream.close()
+        if process is not None:
+            if not finished:  # Stopped early: the decompressor is not needed any more
+                process.kill()
+            if process.wait() and finished:
+                raise OSError(f'{dump_decompressor} failed on {dump_file} (exit status {process.returncode})')
+
+
+# Stream the articles in the dump that are staging targets: those with titles matching title_regex if it is given,
+# otherwise those listed in the base_file. Redirects are left out. Yields (cursor, page) pairs, like the other sources
+# in sd_sources.py; the cursor holds the number of pages read from the dump. The page records are kept in dump_records
+# for dump_fetch
+def dump_pages(dump_file, title_regex=None, cursor=None):
+    titles = None
+    if title_regex is None:
+        titles = {normalize_title(title) for offset, title in basefile_titles(base_file)}
+    count = cursor['pages'] if cursor else 0
+    for title, ns, pageid, revid, is_redirect, text in read_dump(dump_file, count):
+        count += 1
+        if ns != 0 or is_redirect:
+            continue
+        if titles is not None and title not in titles:
+            continue
+        if title_regex is not None and not title_regex.search(title):
+            continue
+        page = pywikibot.Page(wikipedia, title)
+        dump_records.clear()  # The last page has been taken by dump_fetch, or dropped on the way
+        dump_records[title] = dump_record(page, pageid, revid, text)
+        yield {'pages': count}, page
+
+
+# Build a page record (as make_record in sd_fetch.py does) from the dump. The dump has no pageprops, Wikidata item or
+# hidden category information, so a manual {{Short description}} stands in for the wikibase-shortdesc pageprop, and
+# the visible categories are the ones linked directly in the text
+def dump_record(page, pageid, revid, text):
+    pageprops = {}
+    match = manual_shortdesc_regex.search(text)
+    if match:
+        pageprops['wikibase-shortdesc'] = match.group(1)
+    categories = []
+    for name in category_link_regex.findall(text):
+        title = 'Category:' + name[:1].upper() + name[1:].replace('_', ' ')
+        if title not in categories:
+            categories.append(title)
+    return {'page': page,
+            'title': page.title(),
+            'pageid': pageid,
+            'revid': revid,
+            'sha1': hashlib.sha1(text.encode('utf-8')).hexdigest(),
+            'text': text,
+            'missing': False,
+            'pageprops': pageprops,
+            'qid': None,
+            'categories': categories,
+            'lead_only': False,
+            'wikidata_desc': ''}
+
+
+# Yield the dump record of each page, in place of fetch_pages. pages is an iterable of (cursor, page), and each record
+# is given its page's cursor
+def dump_fetch(pages):
+    for cursor, page in pages:
+        record = dump_records.pop(page.title())
+        record['cursor'] = cursor
+        fetched.clear()
+        fetched[record['title']] = record
+        yield record
+
+
+# Read every Template:Taxonomy page in the dump into the taxonomy store, before staging from it. From then on, taxa
+# that are not in the store are taken not to exist, rather than being fetched
+# Skipped if the store is complete, or already has the templates from this dump (eg when resuming), as reading the
+# whole dump takes about as long as staging from it
+def scan_dump_taxonomy(dump_file):
+    if not taxonomy_state['loaded']:
+        load_taxonomy_store()
+    taxonomy_state['offline'] = True
+    dump_id = [os.path.basename(dump_file), os.path.getmtime(dump_file)]
+    if taxonomy_state['complete'] or taxonomy_state['dump'] == dump_id:
+        return
+    print(f'Reading taxonomy templates from {dump_file}')
+    count = 0
+    for title, ns, pageid, revid, is_redirect, text in read_dump(dump_file):
+        if ns == 10 and title.startswith('Template:Taxonomy/'):
+            add_taxonomy_template(title, revid, text)
+            count += 1
+    taxonomy_state['dump'] = dump_id
+    taxonomy_state['changed'] = True
+    save_taxonomy_store()  # So that a later run on this dump need not read it again
+    print(f'{count} taxonomy templates in the dump')
+
+
+# Add a Template:Taxonomy page from the dump to the taxonomy store, unless the store already has that revision
+def add_taxonomy_template(title, revid, text):
+    if not taxonomy_state['loaded']:
+        load_taxonomy_store()
+    taxon = title.split('/', 1)[1]
+    if taxon in taxonomy and taxonomy[taxon][2] == revid:
+        return
+    taxo_rank, isextinct = parse_taxonomy(text)
+    taxonomy[taxon] = [taxo_rank, isextinct, revid]
+    taxonomy_state['changed'] = True
+
+
+# Title as it appears in the dump: spaces for underscores, first letter capitalized
+def normalize_title(title):
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
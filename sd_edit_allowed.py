@@ -1,6 +1,6 @@
 # See sd_run.py for status and copyright release information
 
-from sd_functions import allow_bots
+from sd_functions import allow_bots, page_exists, page_text
 
 
 # Check for various things before allowing a page edit
@@ -29,13 +29,13 @@ def ok_to_edit(page, title, description, username, existing_desc, existing_type,
                     print(title + ' - NO EDIT MADE: Excluded word present in existing SD - ' + excluded)
                     return False
 
-    if '#REDIRECT' in page.text.upper():
+    if '#REDIRECT' in page_text(page).upper():
         print(title + ' - NO EDIT MADE: Page has been converted to a redirect')
         return False
-    if not page.exists():
+    if not page_exists(page):
         print(title + ' - NO EDIT MADE: Page does not exist')
         return False
-    if not page.text:
+    if not page_text(page):
         print(title + ' - NO EDIT MADE: Page blanked or a blank page has been served')
         return False
     if description == existing_desc:
@@ -44,9 +44,9 @@ def ok_to_edit(page, title, description, username, existing_desc, existing_type,
     if '*' in description:
         print(title + ' - NO EDIT MADE: Description starts with "*"')  # Indicates a page that previously failed staging
         return False
-    if '#REDIRECT' in page.text.upper():
+    if '#REDIRECT' in page_text(page).upper():
         print(title + ' - NO EDIT MADE: Page has been converted to a redirect')
-    if not allow_bots(page.text, username):
+    if not allow_bots(page_text(page), username):
         print(title + ' - NO EDIT MADE: Bot is excluded by the Bots template')
         return False
     if title != page.title():  # Unexpected error
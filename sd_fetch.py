@@ -0,0 +1,312 @@
+# See sd_run.py for status and copyright release information
+
+from collections import deque
+
+from pywikibot.data import api
+
+from sd_async import api_query, api_request, run, submit
+from sd_config import *
+
+# Page records for the batch currently being processed, keyed by page title
+fetched = {}
+
+
+# Fetch pages in batches and yield one fully populated page record (a dict) per page, in input order
+# Each batch of up to fetch_batch_size titles costs one API request (plus any continuations), rather than
+# separate requests for text, pageprops, categories and Wikidata item for every page
+# If lead_only, only section 0 of each page's text is fetched. If wikidata, English Wikidata descriptions are added
+# If not categories, the categories are not fetched (record['categories'] is None, as with the category_index)
+# If async_reads, several batches are fetched at once by the asyncio client (see sd_async.py)
+def fetch_pages(pages, batch_size=None, lead_only=False, wikidata=False, categories=True):
+    if async_reads:
+        yield from fetch_pages_async(pages, batch_size, lead_only, wikidata, categories)
+        return
+    for batch in batches(pages, batch_size or fetch_batch_size):
+        yield from fetch_batch(batch, lead_only, wikidata, categories)
+
+
+# As fetch_pages, but with up to async_concurrency batches (each with its Wikidata descriptions) being fetched at once
+# by the asyncio client
+def fetch_pages_async(pages, batch_size=None, lead_only=False, wikidata=False, categories=True):
+    window = deque()
+    for batch in batches(pages, batch_size or fetch_batch_size):
+        window.append((batch, submit(query_batch(batch, lead_only, wikidata, categories))))
+        if len(window) >= async_concurrency:
+            batch, future = window.popleft()
+            results, descs = future.result()
+            yield from store_batch(batch, results, lead_only, wikidata, categories, descs)
+    while window:
+        batch, future = window.popleft()
+        results, descs = future.result()
+        yield from store_batch(batch, results, lead_only, wikidata, categories, descs)
+
+
+# Query a batch of pages by the asyncio client and then, if wikidata, the Wikidata descriptions of their items
+# Returns the API results and a dict of QID -> description (None if not wikidata)
+async def query_batch(batch, lead_only, wikidata, categories):
+    results = await api_query(batch_params(batch, lead_only, categories))
+    if not wikidata:
+        return results, None
+    pageprops = [item.get('pageprops', {}) for result in results for item in result.get('query', {}).get('pages', [])]
+    qids = sorted({props['wikibase_item'] for props in pageprops if props.get('wikibase_item')})
+    descs = {}
+    for params in wikidata_params(qids):
+        try:
+            descs.update(entity_descs(await api_request(params, async_wikidata_url)))
+        except:
+            print('WARNING: Unable to get Wikidata descriptions')
+    return results, descs
+
+
+# Split pages into lists of batch_size
+def batches(pages, batch_size):
+    batch = []
+    for page in pages:
+        batch.append(page)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Query revisions, pageprops and non-hidden categories for a batch of pages, following continuations
+def fetch_batch(batch, lead_only=False, wikidata=False, categories=True):
+    params = batch_params(batch, lead_only, categories)
+    results = []
+    while True:
+        result = api.Request(site=wikipedia, parameters=params).submit()
+        results.append(result)
+        if 'continue' not in result:
+            break
+        params.update(result['continue'])
+    return store_batch(batch, results, lead_only, wikidata, categories)
+
+
+# API parameters for a batch query
+def batch_params(batch, lead_only, categories=True):
+    params = {'action': 'query',
+              'format': 'json',
+              'formatversion': 2,
+              'prop': 'revisions|pageprops',
+              'rvprop': 'ids|sha1|content',
+              'rvslots': 'main',
+              'titles': '|'.join(page.title() for page in batch)}
+    if lead_only:
+        params['rvsection'] = 0
+    if categories and not category_index:  # Otherwise categories are read from the index, or not needed
+        params.update(prop='revisions|pageprops|categories', clshow='!hidden', cllimit='max')
+    return params
+
+
+# Build the records for a batch from its (possibly continued) API results, and make them the current batch
+# descs are the batch's Wikidata descriptions, if already looked up (see query_batch)
+def store_batch(batch, results, lead_only=False, wikidata=False, categories=True, descs=None):
+    entries = {}
+    normalized = {}
+    for result in results:
+        query = result.get('query', {})
+        for item in query.get('normalized', []):
+            normalized[item['from']] = item['to']
+        for item in query.get('pages', []):
+            merge_page_result(entries.setdefault(item['title'], {}), item)
+
+    # Replace the previous batch with this one, so memory use is bounded by the batch size
+    fetched.clear()
+    records = []
+    for page in batch:
+        title = page.title()
+        item = entries.get(normalized.get(title, title), {})
+        record = make_record(page, item)
+        record['lead_only'] = lead_only
+        if not categories:
+            record['categories'] = None
+        fetched[title] = record
+        records.append(record)
+    if wikidata:
+        fetch_wikidata_descs(records, descs)
+    return records
+
+
+# Add the English Wikidata description of each record's item as record['wikidata_desc'], 50 items per request
+# Unless descs (a dict of QID -> description) already holds them
+def fetch_wikidata_descs(records, descs=None):
+    if descs is None:
+        descs = {}
+        for params in wikidata_params([record['qid'] for record in records if record['qid']]):
+            try:
+                result = api.Request(site=wikipedia.data_repository(), parameters=params).submit()
+            except:
+                print('WARNING: Unable to get Wikidata descriptions')
+                continue
+            descs.update(entity_descs(result))
+    for record in records:
+        record['wikidata_desc'] = descs.get(record['qid'], '')
+
+
+# API parameters for looking up the English descriptions of Wikidata items, 50 at a time
+def wikidata_params(qids):
+    for i in range(0, len(qids), 50):
+        yield {'action': 'wbgetentities',
+               'format': 'json',
+               'ids': '|'.join(qids[i:i + 50]),
+               'props': 'descriptions',
+               'languages': 'en'}
+
+
+# The English descriptions in a wbgetentities result, as a dict of QID -> description
+def entity_descs(result):
+    return {qid: entity.get('descriptions', {}).get('en', {}).get('value', '')
+            for qid, entity in result.get('entities', {}).items()}
+
+
+# Merge one (possibly continued) page entry from an API result into the accumulated entry
+def merge_page_result(entry, item):
+    for key, val in item.items():
+        if key == 'categories':
+            entry.setdefault('categories', []).extend(val)
+        elif key == 'pageprops':
+            entry.setdefault('pageprops', {}).update(val)
+        elif key == 'revisions' and not val:
+            continue
+        else:
+            entry[key] = val
+
+
+# Build the page record handed to the main loop
+def make_record(page, item):
+    text = ''
+    revid = sha1 = None
+    if item.get('revisions'):
+        revision = item['revisions'][0]
+        revid = revision.get('revid')
+        sha1 = revision.get('sha1')  # Of the whole revision, even if only section 0 was fetched
+        text = revision['slots']['main'].get('content', '')
+    pageprops = item.get('pageprops', {})
+    return {'page': page,
+            'title': page.title(),
+            'pageid': item.get('pageid'),
+            'revid': revid,
+            'sha1': sha1,
+            'text': text,
+            'missing': item.get('missing', False) or not item,
+            'pageprops': pageprops,
+            'qid': pageprops.get('wikibase_item'),
+            'categories': None if category_index else [cat['title'] for cat in item.get('categories', [])]}
+
+
+# Resolve titles in bulk (up to 50), following normalizations and redirects. Returns a dict of title -> (info, target)
+# where info is the API page entry (with pageid, ns, and missing if the page does not exist) for the page reached, and
+# target is that page's title if title is a redirect, or None
+def resolve_titles(titles):
+    params = {'action': 'query',
+              'format': 'json',
+              'formatversion': 2,
+              'prop': 'info',
+              'redirects': 1,
+              'titles': '|'.join(titles)}
+    result = api.Request(site=wikipedia, parameters=params).submit()
+    query = result.get('query', {})
+    normalized = {item['from']: item['to'] for item in query.get('normalized', [])}
+    redirects = {item['from']: item['to'] for item in query.get('redirects', [])}
+    infos = {item['title']: item for item in query.get('pages', [])}
+    resolved = {}
+    for title in titles:
+        target = normalized.get(title, title)
+        redirected = False
+        hops = 0
+        while target in redirects and hops < 10:  # Double redirects are followed too, within reason
+            target = redirects[target]
+            redirected = True
+            hops += 1
+        info = infos.get(target, {'title': target, 'missing': True})
+        resolved[title] = (info, target if redirected else None)
+    return resolved
+
+
+# Check the latest revisions of pages in bulk (up to 50 titles), without fetching their text. Returns a dict of title ->
+# {'revid', 'sha1', 'missing', 'shortdesc', 'bots'}, where shortdesc is the page's wikibase-shortdesc pageprop ('' if
+# none) and bots is True if the page uses {{Bots}} or {{Nobots}}
+def check_revisions(titles):
+    params = {'action': 'query',
+              'format': 'json',
+              'formatversion': 2,
+              'prop': 'revisions|pageprops|templates',
+              'rvprop': 'ids|sha1',
+              'ppprop': 'wikibase-shortdesc',
+              'tltemplates': 'Template:Bots|Template:Nobots',
+              'tllimit': 'max',
+              'titles': '|'.join(titles)}
+    entries = {}
+    normalized = {}
+    while True:
+        result = api.Request(site=wikipedia, parameters=params).submit()
+        query = result.get('query', {})
+        for item in query.get('normalized', []):
+            normalized[item['from']] = item['to']
+        for item in query.get('pages', []):
+            merge_page_result(entries.setdefault(item['title'], {}), item)
+        if 'continue' not in result:
+            break
+        params.update(result['continue'])
+    checks = {}
+    for title in titles:
+        item = entries.get(normalized.get(title, title), {})
+        revision = item['revisions'][0] if item.get('revisions') else {}
+        checks[title] = {'revid': revision.get('revid'),
+                         'sha1': revision.get('sha1'),
+                         'missing': item.get('missing', False) or not item,
+                         'shortdesc': item.get('pageprops', {}).get('wikibase-shortdesc', ''),
+                         'bots': bool(item.get('templates'))}
+    return checks
+
+
+# Replace the section 0 text in record with the full page text
+def fetch_full_text(record):
+    params = {'action': 'query',
+              'format': 'json',
+              'formatversion': 2,
+              'prop': 'revisions',
+              'rvprop': 'ids|sha1|content',
+              'rvslots': 'main',
+              'titles': record['title']}
+    if async_reads:  # By the asyncio client, alongside the batches already in flight
+        results = run(api_query(params))
+    else:
+        results = [api.Request(site=wikipedia, parameters=params).submit()]
+    for result in results:
+        for item in result['query']['pages']:
+            if item.get('revisions'):
+                revision = item['revisions'][0]
+                record['revid'] = revision.get('revid')
+                record['sha1'] = revision.get('sha1')
+                record['text'] = revision['slots']['main'].get('content', '')
+    record['lead_only'] = False
+
+
+# Titles of the non-hidden categories of the page with title, by the asyncio client
+def fetch_visible_categories(title):
+    params = {'action': 'query',
+              'format': 'json',
+              'formatversion': 2,
+              'prop': 'categories',
+              'clshow': '!hidden',
+              'cllimit': 'max',
+              'titles': title}
+    return [cat['title'] for result in run(api_query(params))
+            for item in result.get('query', {}).get('pages', []) for cat in item.get('categories', [])]
+
+
+# Return the prefetched page record for page, or None if it was not fetched in the current batch
+def get_record(page):
+    return fetched.get(page.title())
+
+
+# Stand-in for a pywikibot Page in a staging worker process, which classifies a page from its record alone. It has
+# only the title: everything else is read from the record (see get_record), never from the wiki
+class RecordPage:
+    def __init__(self, title):
+        self.record_title = title
+
+    def title(self):
+        return self.record_title
@@ -1,110 +1,251 @@
 # See sd_run.py for status and copyright release information
 
+from collections import Counter
+
 import mwparserfromhell
 from pywikibot.data import api
 
 from sd_config import *
+from sd_catindex import indexed_categories
+from sd_fetch import fetch_full_text, fetch_visible_categories, fetched, get_record
+from sd_props import indexed_shortdesc
+
+# Pageprops cached for this run, keyed by page title and then by revision id
+pageinfo_cache = {}
+# Hidden status of every category seen in this run, keyed by category title (shared across pages)
+hidden_categories = {}
+# Lower-cased non-hidden category titles of pages that were not prefetched, keyed by page title
+page_categories = {}
 
 
 # UTILITY FUNCTIONS
 
-# Check to see if page matches the criteria. Returns (True, '') or (False, reason)
-def check_criteria(page, lead_text):
-    # We need to match on *everything* specified in the criteria
-    # Returns (True, '') or (False, reason)
+# Page filters are (name, cost, function) triples, run cheapest first. Each function returns '' to accept the page,
+# or the reason for rejecting it. Costs: 'title' needs only the title, 'index' a lookup in a local index, 'text' needs
+# the page text (held locally once the page has been fetched) and 'network' may need an API request
+filter_costs = ('title', 'index', 'text', 'network')
+# Number of pages rejected by each filter in this run, keyed by filter name
+filter_rejects = Counter()
+
+
+# Run the filters that have one of the given costs, cheapest first, stopping at the first rejection
+# Returns (True, '') or (False, reason)
+def run_filters(filters, args, costs=filter_costs):
+    for cost in filter_costs:
+        if cost not in costs:
+            continue
+        for name, filter_cost, function in filters:
+            if filter_cost != cost:
+                continue
+            reason = function(*args)
+            if reason:
+                filter_rejects[name] += 1
+                return False, reason
+    return True, ''
+
+
+# Print the number of pages rejected by each filter
+def print_filter_rejects():
+    if filter_rejects:
+        print('\nREJECTED BY FILTER:')
+        for name, count in filter_rejects.most_common():
+            print(f'  {name}: {count}')
+
+
+# Criteria filters. We need to match on *everything* specified in the criteria
+def criteria_title_regex(page, lead_text):
+    if title_regex_tf and title_regex.match(page.title()) is None:
+        return '**** Title does not match regex'
+    return ''
+
+
+def criteria_lead(page, lead_text):
+    if not lead_text:
+        return '**** Could not create lead (unpaired delimiters)'
+    return ''
+
+
+def criteria_required_words(page, lead_text):
+    for required in required_words:
+        if required not in lead_text:
+            return '**** Required word missing - ' + required
+    return ''
+
+
+def criteria_excluded_words(page, lead_text):
+    for excluded in excluded_words:
+        if excluded in lead_text:
+            return '**** Excluded word present - ' + excluded
+    return ''
+
 
+def criteria_lead_regex(page, lead_text):
+    if text_regex_tf and text_regex.match(lead_text) is None:
+        return '**** Lead does not match regex'
+    return ''
+
+
+# If we intend to override an existing description, it must match existing_desc_regex and the word lists
+def criteria_existing_desc(page, lead_text):
     existing_desc, existing_type = existing_shortdesc(page)
     override = (override_manual and existing_type == 'manual') or (override_embedded and existing_type == 'embedded')
-    if override:    # If we intend to override existing descriptions
-        result = existing_desc_regex.match(existing_desc)  # Returns object if a match, or None
-        # print('EXISTING SD and RESULT: ', existing_desc, existing_type, result)
-        if result is None:
-            return False, '**** Existing description does not match regex'
-        if existing_desc_required_words:  # Skip if existing_desc_required_words == []
-            for required in existing_desc_required_words:
-                if required not in existing_desc:
-                    return False, '**** Required word missing from existing SD - ' + required
-        if existing_desc_excluded_words:
-            for excluded in existing_desc_excluded_words:
-                if excluded in existing_desc:
-                    return False, '**** Excluded word present in existing SD - ' + excluded
+    if not override:
+        return ''
+    if existing_desc_regex.match(existing_desc) is None:
+        return '**** Existing description does not match regex'
+    for required in existing_desc_required_words:
+        if required not in existing_desc:
+            return '**** Required word missing from existing SD - ' + required
+    for excluded in existing_desc_excluded_words:
+        if excluded in existing_desc:
+            return '**** Excluded word present in existing SD - ' + excluded
+    return ''
+
+
+criteria_filters = [
+    ('title regex', 'title', criteria_title_regex),
+    ('no lead', 'text', criteria_lead),
+    ('required word', 'text', criteria_required_words),
+    ('excluded word', 'text', criteria_excluded_words),
+    ('lead regex', 'text', criteria_lead_regex),
+    ('existing description mismatch', 'network', criteria_existing_desc),
+]
 
-    if not lead_text:
-        return False, '**** Could not create lead (unpaired delimiters)'
-    if required_words:  # Skip if required_words == []
-        for required in required_words:
-            if required not in lead_text:
-                return False, '**** Required word missing - ' + required
-    if excluded_words:
-        for excluded in excluded_words:
-            if excluded in lead_text:
-                return False, '**** Excluded word present - ' + excluded
-    if text_regex_tf:
-        result = text_regex.match(lead_text)  # Returns object if a match, or None
-        if result is None:
-            return False, '**** Lead does not match regex'
-    if title_regex_tf:
-        result = title_regex.match(page.title())  # Returns object if a match, or None
-        if result is None:
-            return False, '**** Title does not match regex'
 
+# Check to see if page matches the criteria. Returns (True, '') or (False, reason)
+def check_criteria(page, lead_text, costs=filter_costs):
+    return run_filters(criteria_filters, (page, lead_text), costs)
 
-    return True, ''
 
+# Page filters: are we interested in this page at all?
+def page_is_list(page):
+    if 'list of' in page.title().lower():  # Ignore articles entitled "List of ..."
+        return 'Is a list article'
+    return ''
 
-# Are we interested in this page at all?  Returns (True, '') or (False, reason)
-def check_page(page):
-    has_infobox = False
-    # Ignore articles entitled "List of ..."
-    if 'list of' in page.title().lower():
-        return False, 'Is a list article'
-    # Check for existing short description, where relevant
+
+def page_is_redirect(page):
+    if '#REDIRECT' in page_text(page).upper():
+        return 'Is a redirect'
+    return ''
+
+
+# When only section 0 has been fetched (fetch_lead_only), only that is searched. This is intended: an infobox belongs
+# at the top of the article, and a page whose infobox is lower down is not a target
+def page_lacks_infobox(page):
+    if not require_infobox:
+        return ''
+    text = page_text(page).lower()
+    for item in infobox_strings:  # Check through the various strings that identify an infobox
+        if item.lower() in text:
+            return ''
+    return 'Does not have an infobox'
+
+
+# A second infobox may be further down the page, so the full text is fetched if only section 0 has been
+def page_has_infoboxes(page):
+    if not (require_infobox and sole_infobox):
+        return ''
+    record = get_record(page)
+    if record is not None and record['lead_only'] and not record['missing']:
+        fetch_full_text(record)
+    if count_infoboxes(page) > 1:
+        return 'Has multiple infoboxes'
+    return ''
+
+
+# Check for existing short description, where relevant
+def page_has_shortdesc(page):
+    if override_manual and override_embedded:
+        return ''
     existing_type = existing_shortdesc(page)[1]
     if not override_manual and existing_type == 'manual':
-        return False, 'Already has manual short description'
+        return 'Already has manual short description'
     if not override_embedded and existing_type == 'embedded':
-        return False, 'Already has embedded short description'
-    # Ignore redirects
-    if '#REDIRECT' in page.text.upper():
-        return False, 'Is a redirect'
-    # Check for required infobox(es)
-    if require_infobox:
-        for item in infobox_strings:  # Check through the various strings that identify an infobox
-            if item.lower() in page.text.lower():
-                has_infobox = True
-        if not has_infobox:
-            return False, 'Does not have an infobox'
-        if sole_infobox:
-            if count_infoboxes(page) > 1:
-                return False, 'Has multiple infoboxes'
+        return 'Already has embedded short description'
+    return ''
+
+
+# Check for a short description listed in the offline shortdesc_index. Where the index does not say whether the
+# description is manual or embedded, the page is left for the live check unless neither may be overridden
+def page_has_indexed_shortdesc(page):
+    if not shortdesc_index or (override_manual and override_embedded):
+        return ''
+    existing_type = indexed_shortdesc(page.title())
+    if existing_type == 'unknown' and not override_manual and not override_embedded:
+        return 'Already has short description (offline index)'
+    if not override_manual and existing_type == 'manual':
+        return 'Already has manual short description (offline index)'
+    if not override_embedded and existing_type == 'embedded':
+        return 'Already has embedded short description (offline index)'
+    return ''
 
-    return True, ''
+
+page_filters = [
+    ('list article', 'title', page_is_list),
+    ('existing description (offline index)', 'index', page_has_indexed_shortdesc),
+    ('redirect', 'text', page_is_redirect),
+    ('no infobox', 'text', page_lacks_infobox),
+    ('multiple infoboxes', 'text', page_has_infoboxes),
+    ('existing description', 'network', page_has_shortdesc),
+]
+
+
+# Are we interested in this page at all?  Returns (True, '') or (False, reason)
+# costs limits the filters run, eg to ('title',) to screen pages before fetching them
+def check_page(page, costs=filter_costs):
+    return run_filters(page_filters, (page,), costs)
 
 
 # Check for existing sd. Return (sd, 'manual') if standard sd template, or (sd, 'embedded) if created eg via an infobox
 def existing_shortdesc(page):
-    description = ''
-    pageinfo = get_pageinfo(wikipedia, page)
-    for item in pageinfo['query']['pages']:
-        try:
-            description = pageinfo['query']['pages'][item]['pageprops']['wikibase-shortdesc']
-            # print('DESCRIPTION FOUND: ', description)
-        except:  # Throws an exception if there is no embedded or manual description
-            # print('NO DESCRIPTION FOUND')
-            return '', None
-    if '{{short description' in page.text or '{{Short description' in page.text:
+    description = get_pageprops(page).get('wikibase-shortdesc', '')
+    if not description:  # There is no embedded or manual description
+        return '', None
+    text = page_text(page)
+    if '{{short description' in text or '{{Short description' in text:
         sdtype = 'manual'
     else:
         sdtype = 'embedded'
-    if len(description) > 0:
-        return description, sdtype
-    return '', None
+    return description, sdtype
+
+
+# Get the pageprops of page: from its prefetched record if there is one, otherwise from pageinfo_cache or the API
+# Within a run, each revision of a page is queried at most once, so all checks read the same snapshot
+def get_pageprops(page):
+    record = get_record(page)
+    if record is not None:
+        return record['pageprops']
+    revisions = pageinfo_cache.setdefault(page.title(), {})
+    revid = page_revid(page)
+    if revid not in revisions:
+        pageinfo = get_pageinfo(wikipedia, page)
+        pageprops = {}
+        for item in pageinfo['query']['pages']:
+            pageprops = pageinfo['query']['pages'][item].get('pageprops', {})
+        revisions[revid] = pageprops
+    return revisions[revid]
+
+
+# Forget everything cached for page. Call after page.save, since the page's pageprops may have changed
+def invalidate_pageinfo(page):
+    pageinfo_cache.pop(page.title(), None)
+    page_categories.pop(page.title(), None)
+    fetched.pop(page.title(), None)
 
 
 # Get the description from Wikidata
 def get_wikidata_desc(page):
+    if not use_wikidata:
+        return ''
+    record = get_record(page)
+    if record is not None and 'wikidata_desc' in record:  # Already looked up, in a batch
+        return record['wikidata_desc']
     try:
-        wd_item = pywikibot.ItemPage.fromPage(page, wikipedia)
+        if record is not None and record['qid']:  # QID is already known from pageprops
+            wd_item = pywikibot.ItemPage(wikipedia.data_repository(), record['qid'])
+        else:
+            wd_item = pywikibot.ItemPage.fromPage(page, wikipedia)
         item_dict = wd_item.get()
         qid = wd_item.title()
     except:
@@ -163,13 +304,41 @@ def clean_title(title_str):
 # Count the number of infoboxes
 def count_infoboxes(page):
     count = 0
-    templates = pywikibot.textlib.extract_templates_and_params(page.text)
+    templates = pywikibot.textlib.extract_templates_and_params(page_text(page))
     for template in templates:
         if 'infobox' in template[0].lower():
             count += 1
     return count
 
 
+# Page text, taken from the prefetched page record if there is one
+def page_text(page):
+    record = get_record(page)
+    if record is not None:
+        return record['text']
+    return page.text
+
+
+# Does page exist? From its prefetched record if there is one
+def page_exists(page):
+    record = get_record(page)
+    if record is not None:
+        return not record['missing']
+    return page.exists()
+
+
+# Latest revision id of page (None if the page does not exist). Loads the page text if not already loaded
+def page_revid(page):
+    record = get_record(page)
+    if record is not None:
+        return record['revid']
+    try:
+        page_text(page)
+        return page.latest_revision_id
+    except:
+        return None
+
+
 # Fetch the page
 def get_pageinfo(site, itemtitle):
     params = {'action': 'query',
@@ -235,14 +404,71 @@ def confirm_edit(tit, ex_desc, ex_type, desc):
 
 # Check whether text_frag occurs anywhere within the name of a non-hidden page category (case-insensitive)
 def in_category(page, text_frag):
+    text_frag = text_frag.lower()
+    for cat in known_categories(page):
+        if text_frag in cat:
+            return True
+    return False
+
+
+# visible_categories, or none if they cannot be looked up (eg if the API request fails)
+def known_categories(page):
     try:
-        catlist = [cat.title() for cat in page.categories() if 'hidden' not in cat.categoryinfo]
-        for cat in catlist:
-            if text_frag.lower() in cat.lower():
-                return True
+        return visible_categories(page)
     except:
-        return False
-    return False
+        return []
+
+
+# Lower-cased titles of the non-hidden categories of page, worked out once per page
+def visible_categories(page):
+    record = get_record(page)
+    if record is not None:
+        return record_categories(record)
+    title = page.title()
+    if title not in page_categories:
+        page_categories[title] = live_categories(page)
+    return page_categories[title]
+
+
+# Visible categories of a fetched page: from the category_index if the page is there, otherwise from the record or,
+# if the record has none (not fetched because of the index), live
+def record_categories(record):
+    if 'category_names' not in record:
+        names = None
+        if category_index and record['pageid']:
+            names = indexed_categories(record['pageid'])
+        if names is None and record['categories'] is None:
+            names = live_categories(record['page'])
+        elif names is None:  # Hidden categories were already excluded by the API
+            for cat in record['categories']:
+                hidden_categories[cat] = False
+            names = frozenset(cat.lower() for cat in record['categories'])
+        record['category_names'] = names
+    return record['category_names']
+
+
+# Visible categories of page, looked up live. If async_reads, by the asyncio client, which leaves out the hidden ones
+def live_categories(page):
+    if async_reads:
+        return frozenset(cat.lower() for cat in fetch_visible_categories(page.title()))
+    cats = [cat.title() for cat in page.categories()]
+    load_hidden_categories([cat for cat in cats if cat not in hidden_categories])
+    return frozenset(cat.lower() for cat in cats if not hidden_categories[cat])
+
+
+# Look up whether each category in cats is hidden, 50 at a time, and add the results to hidden_categories
+def load_hidden_categories(cats):
+    for i in range(0, len(cats), 50):
+        params = {'action': 'query',
+                  'format': 'json',
+                  'formatversion': 2,
+                  'prop': 'categoryinfo',
+                  'titles': '|'.join(cats[i:i + 50])}
+        result = api.Request(site=wikipedia, parameters=params).submit()
+        for item in result['query']['pages']:
+            hidden_categories[item['title']] = item.get('categoryinfo', {}).get('hidden', False)
+        for cat in cats[i:i + 50]:  # (Titles the API normalised differently are treated as visible)
+            hidden_categories.setdefault(cat, False)
 
 
 # Get text within s between the first occurrence of start and the subsequent first occurrence of end
@@ -1,10 +1,12 @@
 # See sd_run.py for status and copyright release information
 
+from collections import Counter
 from statistics import multimode
 
 from sd_adjust_desc import adjust_desc
 from sd_functions import *
 from sd_is_monotypic_genus import is_monotypic_genus
+from sd_parse_taxobox import parse_taxobox
 from sd_rank_from import rank_from_category, rank_from_lead, rank_from_speciesbox, \
     rank_from_taxobox, info_from_autobox
 
@@ -13,19 +15,23 @@ from sd_rank_from import rank_from_category, rank_from_lead, rank_from_speciesbo
 # NOTE: For each bot task, the code here needs to be hand-crafted
 def shortdesc_generator(page, lead_text):
     #  Make compressed searchable version of page text
-    text_compressed = page.text.lower().replace(' ', '')
+    text_compressed = page_text(page).lower().replace(' ', '')
 
     # Get title, ignoring brackets
     title = page.title()
     title_nobra = re.sub(r'\(.+?\)', '', title).strip()
     single_word_title = True if len(title_nobra.split()) == 1 else False
 
-    rank_category = rank_from_category(page)
-    rank_lead = rank_from_lead(title_nobra, lead_text, name_singular, verbose_stage)
-    rank_speciesbox = rank_from_speciesbox(text_compressed)
-    rank_taxobox = rank_from_taxobox(title_nobra, text_compressed)
-    rank_autobox, isextinct_autobox = info_from_autobox(wikipedia, text_compressed)
-    all_ranks = [rank_category, rank_lead, rank_speciesbox, rank_taxobox, rank_autobox]
+    # The Automatictaxobox may need a template fetch, so only look at it when its rank or extinct status is needed
+    autobox = {}
+
+    def autobox_info():
+        if not autobox:
+            autobox['rank'], autobox['isextinct'] = info_from_autobox(wikipedia, text_compressed)
+        return autobox['rank'], autobox['isextinct']
+
+    def isextinct_autobox():
+        return autobox_info()[1]
 
     # Must be Variety or Subspecies if so noted in title
     if 'var.' in title:
@@ -49,6 +55,27 @@ def shortdesc_generator(page, lead_text):
         shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_singular)
         return True, adjust_desc(page, lead_text, shortdesc, isextinct_autobox)
 
+    # Evaluate the rank sources cheapest first, stopping once the remaining ones could not change the best rank
+    taxobox = parse_taxobox(text_compressed)  # Taxobox parameters, from one pass over the text
+    rank_sources = [
+        ('speciesbox', lambda: rank_from_speciesbox(taxobox)),
+        ('taxobox', lambda: rank_from_taxobox(title_nobra, taxobox)),
+        ('lead', lambda: rank_from_lead(title_nobra, lead_text, name_singular, verbose_stage)),
+        ('category', lambda: rank_from_category(page)),
+        ('autobox', lambda: autobox_info()[0]),
+    ]
+    ranks = {}
+    for source, rank_from in rank_sources:
+        ranks[source] = rank_from()
+        if rank_settled(ranks.values(), len(rank_sources) - len(ranks)):
+            break
+    rank_category = ranks.get('category')
+    rank_lead = ranks.get('lead')
+    rank_speciesbox = ranks.get('speciesbox')
+    rank_taxobox = ranks.get('taxobox')
+    rank_autobox = ranks.get('autobox')
+    all_ranks = [rank_category, rank_lead, rank_speciesbox, rank_taxobox, rank_autobox]
+
     # Get the most common rank from the list (excluding None)
     all_ranks_xnone = [x for x in all_ranks if x is not None]
     best_ranks = multimode(all_ranks_xnone)  # List of most common ranks (eg a list of 2 if there is a tie)
@@ -59,6 +86,7 @@ def shortdesc_generator(page, lead_text):
     if verbose_stage:
         print('rank_category, rank_lead, rank_speciesbox, rank_taxobox, rank_autobox')
         print(all_ranks)
+        print('Not evaluated: ', [source for source, rank_from in rank_sources if source not in ranks])
         print(all_ranks_xnone)
         print('best_ranks: ', best_ranks, 'Best rank: ', best_rank)
 
@@ -66,7 +94,7 @@ def shortdesc_generator(page, lead_text):
     if best_rank:
 
         if single_word_title:  # Species is unexpected if single-word title; but may be monotypic genus
-            if best_rank == 'Species' and is_monotypic_genus(text_compressed, lead_text):
+            if best_rank == 'Species' and is_monotypic_genus(text_compressed, lead_text, section_0_categories(page)):
                 best_rank = 'Genus'
                 shortdesc = best_rank + ' of ' + shortdesc_end(best_rank, name_singular, name_plural)
                 return True, adjust_desc(page, lead_text, shortdesc, isextinct_autobox)
@@ -129,3 +157,22 @@ def shortdesc_generator(page, lead_text):
         return False, f'***** :  AUTOTAXOBOX HAS {rank_autobox}'
 
     return False, "***** : CAN'T GET BEST RANK"
+
+
+# Is the single best rank already certain, whatever the remaining (unevaluated) rank sources return?
+# True if the most common rank is ahead of the next by more than the number of sources remaining
+def rank_settled(ranks, remaining):
+    counts = Counter(rank for rank in ranks if rank is not None).most_common(2)
+    if not counts:
+        return False
+    runner_up = counts[1][1] if len(counts) > 1 else 0
+    return counts[0][1] > runner_up + remaining
+
+
+# The visible categories of page, if only section 0 of its text was fetched (fetch_lead_only), as category links at
+# the foot of the page are then missing from its text. Otherwise none: the text has them all
+def section_0_categories(page):
+    record = get_record(page)
+    if record is not None and record['lead_only'] and not record['missing']:
+        return known_categories(page)
+    return ()
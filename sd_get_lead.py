@@ -1,29 +1,48 @@
 # See sd_run.py for status and copyright release information
 
 from sd_config import *
-from sd_functions import find_parens, clean_text
+from sd_fetch import get_record
+from sd_functions import find_parens, clean_text, page_text
+
+# Section headings, as recognised by pywikibot.textlib.extract_sections
+header_regex = pywikibot.textlib.get_regexes('header')[0]
+# Parts that extract_sections treats as disabled, in the order it removes them, each with a (generous) pattern for
+# its opening tag
+disabled_parts = [(regex, re.compile(opener, re.IGNORECASE)) for regex, opener in zip(
+    pywikibot.textlib.get_regexes(['comment', 'includeonly', 'nowiki', 'pre', 'syntaxhighlight']),
+    [r'<!--', r'<includeonly(?:>|\s|\Z)', r'<nowiki(?:>|\s|\Z)', r'<pre(?:>|\s|\Z)', r'<syntaxhighlight(?:>|\s|\Z)'])]
 
 
 # Clean up lead and get the first 150 chars
+# Each step is a single pass over the lead, and the final clean up stops once it has 150 characters
+# Section 0 is taken from the page record if it has been worked out already (see plain_record in sd_stage.py)
 def get_lead(page):
-    sections = pywikibot.textlib.extract_sections(page.text, wikipedia)
-    lead = sections[0]
+    record = get_record(page)
+    if record is not None and 'section_0' in record:
+        return lead_from_section(record['section_0'])
+    return lead_from_text(page_text(page))
+
+
+# Clean up the lead of text and get the first 150 chars
+def lead_from_text(text):
+    return lead_from_section(lead_section(text))
+
+
+# Clean up section 0 of a page and get the first 150 chars
+def lead_from_section(lead):
     # Remove any templates: {{ ... }}
     # First, replace template double braces with single so we can use find_parens
     try:
         lead = lead.replace("{{", "{")
         lead = lead.replace("}}", "}")
         result = find_parens(lead, '{', '}')  # Get start and end indexes for all templates
-        # Go through templates and replace with ` strings of same length, to avoid changing index positions
-        for key in result:
-            start = key
-            end = result[key]
-            length = end - start + 1
-            lead = lead.replace(lead[start:end + 1], "`" * length)
+        # Replace all templates with ` strings of same length, to avoid changing index positions
+        lead = blank_spans(lead, result)
     except IndexError:
         pass
 
     # Deal with piped wikilinks: replace [[xxx|yyy]] with [[yyy]]
+    # (re.MULTILINE is in the count position, so only the first 8 are replaced. Kept so the output is unchanged)
     lead = re.sub(r"\[([^\]\[|]*)\|", "[", lead, re.MULTILINE)
 
     # Remove any images: [[File: ... ]] or [[Image: ... ]]
@@ -32,14 +51,8 @@ def get_lead(page):
         lead = lead.replace("[[", "[")
         lead = lead.replace("]]", "]")
         result = find_parens(lead, '[', ']')  # Get start and end indexes for all square brackets
-        # Go through results and replace wikicode representing images with ` strings of same length
-        for key in result:
-            start = key
-            end = result[key]
-            strstart = lead[start + 1:start + 7]
-            if 'File:' in strstart or 'Image:' in strstart:
-                length = end - start + 1
-                lead = lead.replace(lead[start:end + 1], "`" * length)
+        # Replace wikicode representing images with ` strings of same length
+        lead = blank_spans(lead, result, lambda strstart: 'File:' in strstart or 'Image:' in strstart)
     except IndexError:
         pass
 
@@ -51,22 +64,74 @@ def get_lead(page):
         lead = lead.replace("<ref", "!")
         lead = lead.replace("ref>", "~")
         lead = lead.replace("ref >", "~")
-        # # Go through templates and replace with ` strings of same length
+        # # Replace refs with ` strings of same length
         result = find_parens(lead, '!', '~')  # Get start and end indexes for sentinels
-        for key in result:
-            start = key
-            end = result[key]
-            length = end - start + 1
-            lead = lead.replace(lead[start:end + 1], "`" * length)
+        lead = blank_spans(lead, result)
     except:  # (Don't know why, but need to reverse the replacements here)
         lead = lead.replace("!", "<ref")
         lead = lead.replace("~", "ref>")
 
-    # Delete the temporary ` strings and clean up
-    try:
-        lead = clean_text(lead)  # (includes removal of remaining '[' and ']')
-        lead = lead[:150].strip()
-    except:
-        pass
+    # Delete the temporary ` strings and clean up (includes removal of remaining '[' and ']')
+    return clean_lead(lead, 150)
+
+
+# Get section 0 of text, exactly as pywikibot.textlib.extract_sections(text, wikipedia)[0] would
+# extract_sections checks every heading against the whole page, so give it only the text up to the first heading
+# when nothing there (comments, nowiki etc) could be closed further down the page
+def lead_section(text):
+    match = header_regex.search(text)
+    if match:
+        truncated = text[:match.end()]
+        if not unclosed_disabled_part(truncated):
+            sections = pywikibot.textlib.extract_sections(truncated, wikipedia)
+            if sections[1]:
+                return sections[0]
+    return pywikibot.textlib.extract_sections(text, wikipedia)[0]
+
+
+# Would removing the disabled parts of text, in the same order as extract_sections does, leave any part unclosed?
+def unclosed_disabled_part(text):
+    for regex, opener in disabled_parts:
+        text = regex.sub('', text)
+        if opener.search(text):
+            return True
+    return False
+
+
+# Replace the spans in s (a dict of start: end indexes, as from find_parens) with ` strings of the same length
+# Spans are taken in the order given, so inner spans are replaced before the spans that contain them.
+# If is_wanted is given, a span is replaced only if is_wanted(<the 6 characters after its opening character>)
+def blank_spans(s, spans, is_wanted=None):
+    mask = bytearray(len(s))
+    for start, end in spans.items():
+        if is_wanted is not None:
+            strstart = ''.join('`' if mask[i] else s[i] for i in range(start + 1, min(start + 7, len(s))))
+            if not is_wanted(strstart):
+                continue
+        mask[start:end + 1] = b'\x01' * (end + 1 - start)
+
+    pieces = []
+    pos = 0
+    while True:
+        start = mask.find(1, pos)
+        if start == -1:
+            break
+        end = mask.find(0, start)
+        if end == -1:
+            end = len(s)
+        pieces.append(s[pos:start])
+        pieces.append('`' * (end - start))
+        pos = end
+    pieces.append(s[pos:])
+    return ''.join(pieces)
+
 
-    return lead
+# Same as clean_text(lead)[:length].strip(), but cleans only as much of lead as is needed
+# (Cleaning changes only a few characters either side of any point, so a long enough prefix gives the same start)
+def clean_lead(lead, length):
+    limit = 4 * length
+    while True:
+        cleaned = clean_text(lead[:limit])
+        if len(cleaned) >= length + 50 or limit >= len(lead):
+            return cleaned[:length].strip()
+        limit *= 4
@@ -1,7 +1,9 @@
 # See sd_run.py for status and copyright release information
 
 # Return True if a monotypic genus article. Call ony when a single-word species article is suspected to be a genus
-def is_monotypic_genus(text_compressed, lead_text):
+# categories (lower-case category titles) covers the case where text_compressed holds only the lead. Pass them only
+# then, as they include categories added by templates, which the text alone does not show
+def is_monotypic_genus(text_compressed, lead_text, categories=()):
     mono_list_page = ['[[category:monotypic']
     mono_list_lead = ['monotypic', 'monospecific', ' a single species', ' the single species',
                       ' single-species', ' only one species', ' only the one species', ' the only species',
@@ -10,6 +12,9 @@ def is_monotypic_genus(text_compressed, lead_text):
     for mono in mono_list_page:  # Parse entire page
         if mono.lower() in text_compressed:
             return True
+        for cat in categories:
+            if ('[[' + cat.replace(' ', '')).startswith(mono):
+                return True
         for mono in mono_list_lead:  # Parse the lead only
             if mono in lead_text.lower():
                 return True
@@ -0,0 +1,51 @@
+# See sd_run.py for status and copyright release information
+import re
+
+# One token per template opening ("{{name", matched at every position) or per parameter ("|name=" plus any quote
+# marks and the first character of the value)
+taxobox_tokens = re.compile(r"(?=\{\{([a-z]*))|\|([^|={}]*)=('*)(\w?)")
+
+
+# Walk the compressed page text once and return a compact record of its taxobox-style parameters:
+#   'templates': names of all templates opened ('{{speciesbox', '{{taxobox', etc)
+#   'plain': parameters with a value that starts with a letter or digit (no quote marks)
+#   'italic': parameters with a value in at least italic (two or more quote marks)
+#   'bold_italic': parameters with a value in bold italic (five or more quote marks)
+#   'bold_italic_values': the bold italic values of each parameter, eg {'genus': {'abacetus'}}
+# Parameters are collected from the whole text, just as the substring tests in the rank functions used to be
+def parse_taxobox(text_compressed):
+    templates = set()
+    plain = set()
+    italic = set()
+    bold_italic = set()
+    bold_italic_values = {}
+    for match in taxobox_tokens.finditer(text_compressed):
+        name = match.group(2)
+        if name is None:
+            templates.add(match.group(1))
+            continue
+        quotes = len(match.group(3))
+        if not quotes:
+            if match.group(4):
+                plain.add(name)
+            continue
+        if quotes >= 2:
+            italic.add(name)
+        if quotes >= 5:
+            bold_italic.add(name)
+            if quotes == 5:  # Value up to the closing quote marks (titles are at most 255 characters)
+                start = match.end(3)
+                end = text_compressed.find("'''''", start, start + 260)
+                if end != -1:
+                    bold_italic_values.setdefault(name, set()).add(text_compressed[start:end])
+
+    return {'templates': templates, 'plain': plain, 'italic': italic, 'bold_italic': bold_italic,
+            'bold_italic_values': bold_italic_values}
+
+
+# Is there a template whose name starts with name? (Same as testing for '{{' + name in the compressed text)
+def has_template(taxobox, name):
+    for template in taxobox['templates']:
+        if template.startswith(name):
+            return True
+    return False
@@ -0,0 +1,110 @@
+# See sd_run.py for status and copyright release information
+
+# Offline index of the articles that already have a short description, built from the database dumps, so that staging
+# can drop them before making any API request. Set shortdesc_index in sd_config.py to use it
+# The index is an sqlite file holding the title and page id of each article with a wikibase-shortdesc pageprop, and
+# whether its text has a {{Short description}} template (manual) or not (embedded). The manual flag comes from a
+# pages-articles dump (see sd_dump.py); without one it is left unknown
+# Usage:
+#   python sd_props.py <page.sql.gz> <page_props.sql.gz> [<pages-articles.xml.bz2>]
+
+import gzip
+import os
+import sqlite3
+import sys
+import time
+
+from sd_config import *
+
+# The open index, if any
+index_state = {'db': None}
+
+# A row of the page table: page_id, page_namespace, page_title, then the rest of the row (skipped)
+page_row_regex = re.compile(r"\((\d+),(-?\d+),'((?:[^'\\]|\\.)*)',(?:'(?:[^'\\]|\\.)*'|[^'()])*\)")
+# A row of the page_props table: pp_page, pp_propname, pp_value, pp_sortkey (skipped)
+props_row_regex = re.compile(r"\((\d+),'((?:[^'\\]|\\.)*)','((?:[^'\\]|\\.)*)',[^'()]*\)")
+sql_escape_regex = re.compile(r'\\(.)')
+sql_escapes = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+
+
+# Rows matched by row_regex in the INSERT statements of an SQL dump (.sql or .sql.gz), read one line at a time
+def sql_rows(sql_file, row_regex):
+    opener = gzip.open if sql_file.endswith('.gz') else open
+    with opener(sql_file, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('INSERT INTO'):
+                yield from row_regex.findall(line)
+
+
+def sql_unescape(value):
+    if '\\' not in value:
+        return value
+    return sql_escape_regex.sub(lambda match: sql_escapes.get(match.group(1), match.group(1)), value)
+
+
+# Build the index from the page and page_props dumps, and the pages-articles dump if given
+# Written to a temporary file that replaces index_file when complete
+def build_index(index_file, page_file, props_file, articles_file=None):
+    start = time.time()
+    if os.path.exists(index_file + '.tmp'):
+        os.remove(index_file + '.tmp')
+    db = sqlite3.connect(index_file + '.tmp')
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('CREATE TEMP TABLE props (pageid INTEGER PRIMARY KEY)')
+    db.execute('CREATE TABLE shortdesc (title TEXT PRIMARY KEY, pageid INTEGER, manual INTEGER) WITHOUT ROWID')
+    db.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+
+    print(f'Reading {props_file}')
+    rows = ((int(pageid),) for pageid, name, value in sql_rows(props_file, props_row_regex)
+            if name == 'wikibase-shortdesc')
+    db.executemany('INSERT OR IGNORE INTO props VALUES (?)', rows)
+    print(f'{db.execute("SELECT COUNT(*) FROM props").fetchone()[0]} pages have a short description')
+
+    print(f'Reading {page_file}')
+    db.execute('CREATE TEMP TABLE pages (pageid INTEGER PRIMARY KEY, title TEXT)')
+    rows = ((int(pageid), sql_unescape(title).replace('_', ' '))
+            for pageid, ns, title in sql_rows(page_file, page_row_regex) if ns == '0')
+    db.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?)', rows)
+    db.execute('INSERT OR REPLACE INTO shortdesc SELECT title, pageid, NULL FROM pages JOIN props USING (pageid)')
+    db.execute('CREATE INDEX shortdesc_pageid ON shortdesc (pageid)')
+    count = db.execute('SELECT COUNT(*) FROM shortdesc').fetchone()[0]
+    print(f'{count} articles have a short description')
+
+    if articles_file:
+        from sd_dump import read_dump
+        print(f'Reading {articles_file}')
+        for title, ns, pageid, revid, is_redirect, text in read_dump(articles_file):
+            if ns != 0 or is_redirect:
+                continue
+            manual = int('{{short description' in text or '{{Short description' in text)
+            db.execute('UPDATE shortdesc SET manual = ? WHERE pageid = ?', (manual, pageid))
+
+    db.executemany('INSERT INTO info VALUES (?, ?)', [('built', str(time.time())), ('page', page_file),
+                                                      ('page_props', props_file), ('articles', articles_file or '')])
+    db.commit()
+    db.execute('DROP TABLE props')
+    db.execute('DROP TABLE pages')
+    db.execute('VACUUM')
+    db.close()
+    os.replace(index_file + '.tmp', index_file)
+    print(f'Index of {count} articles written to {index_file} in {time.time() - start:.0f} seconds')
+
+
+# Look up a title in the shortdesc_index. Returns None if the article had no short description when the dumps were
+# made, otherwise its type as in existing_shortdesc: 'manual' or 'embedded', or 'unknown' if built without the text
+def indexed_shortdesc(title):
+    if index_state['db'] is None:
+        index_state['db'] = sqlite3.connect(f'file:{shortdesc_index}?mode=ro', uri=True)
+    row = index_state['db'].execute('SELECT manual FROM shortdesc WHERE title = ?', (title,)).fetchone()
+    if row is None:
+        return None
+    return {None: 'unknown', 1: 'manual', 0: 'embedded'}[row[0]]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: python sd_props.py <page.sql.gz> <page_props.sql.gz> [<pages-articles.xml.bz2>]')
+        sys.exit(1)
+    build_index(shortdesc_index or 'shortdesc index.sqlite', sys.argv[1], sys.argv[2],
+                sys.argv[3] if len(sys.argv) > 3 else None)
@@ -1,9 +1,11 @@
 # See sd_run.py for status and copyright release information
 import re
-
-import pywikibot
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
 
 from sd_functions import find_between, in_category
+from sd_parse_taxobox import has_template
+from sd_taxonomy import taxonomy_info
 
 
 # Get rank from categories
@@ -38,120 +40,141 @@ def rank_from_category(page):
     return rank
 
 
+# Rank keywords searched for in the lead, in order of precedence. Partial strings to ensure unique matches
+# The third item is True where the looser second pass still requires the tight "is a <keyword>" form
+lead_ranks = [
+    ('Subgenus', 'subgenu', False),
+    ('Genus', 'genus', False),
+    ('Superfamily', 'superfami', False),
+    ('Family', 'famil', False),
+    ('Subfamily', 'subfami', False),
+    ('Tribe', 'tribe', False),
+    ('Subtribe', 'subtrib', False),
+    ('Class', 'class', False),
+    ('Subclass', 'subclas', False),
+    ('Order', 'order', False),
+    ('Suborder', 'suborde', False),
+    ('Infraorder', 'infraorde', True),
+    ('Clade', 'clade', False),
+    ('Variety', 'variet', False),
+    ('Species', 'species', False),
+    ('Informal group', 'informal group', False),
+    ('Phylum', 'phylum', True),
+    ('Subphylum', 'subphylu', True),
+]
+
+
+# Compile the lead matchers once per name_singular
+# lead_tokens finds, in a single scan, every "is a"/"was a" (st1) or "are a"/"were a" (st2), every " in the"
+# and every whitespace-preceded rank keyword (k0, k1, ...). All tokens are zero-width lookaheads, so none can
+# hide another. The species heuristics are a separate (rarely needed) search
+@lru_cache(maxsize=None)
+def lead_matchers(name_singular):
+    keywords = '|'.join(f'(?P<k{i}>{re.escape(keyword)})' for i, (rank, keyword, tight) in enumerate(lead_ranks))
+    lead_tokens = re.compile(rf'(?=(?P<st1>(?:is|was)\sa)|(?P<st2>(?:are|were)\sa)|(?P<inthe>\sin\sthe)|'
+                             rf'\s(?:{keywords}))')
+    regex_sp2 = re.compile(rf'(is\sa|is\san|was\sa|was\san)\s{re.escape(name_singular)}')
+    return lead_tokens, regex_sp2
+
+
 # Get rank from lead
 def rank_from_lead(title_nobra, lead_txt, name_singular, verbose_stage):
-    regex_start1 = "(is\sa|is\san|was\sa|was\san)\s"  # eg "is a genus ..."
-    # Regex2 covers eg "is a" + <maximum of 30 chars not including 'in the'> + "genus"
-    # Need to ensure that "is an order of fungi in the class Tremellomycetes" maps to 'Order' not Class'
-    # Tempered greedy token - http://www.rexegg.com/regex-quantifiers.html#tempered_greed
-    regex_start2 = "(is\sa|are\sa|was\sa|were\sa)(?:(?!\sin\sthe).){0,50}\s"
-
-    lead_dict1 = {  # Partial strings to ensure unique matches
-        'Subgenus': regex_start1 + 'subgenu',
-        'Genus': regex_start1 + 'genus',
-        'Superfamily': regex_start1 + 'superfami',
-        'Family': regex_start1 + 'famil',
-        'Subfamily': regex_start1 + 'subfami',
-        'Tribe': regex_start1 + 'tribe',
-        'Subtribe': regex_start1 + 'subtrib',
-        'Class': regex_start1 + 'class',
-        'Subclass': regex_start1 + 'subclas',
-        'Order': regex_start1 + 'order',
-        'Suborder': regex_start1 + 'suborde',
-        'Infraorder': regex_start1 + 'infraorde',
-        'Clade': regex_start1 + 'clade',
-        'Variety': regex_start1 + 'variet',
-        'Species': regex_start1 + 'species',
-        'Informal group': regex_start1 + 'informal group',
-        'Phylum': regex_start1 + 'phylum',
-        'Subphylum': regex_start1 + 'subphylu',
-    }
-    lead_dict2 = {  # Partial strings to ensure unique matches
-        'Subgenus': regex_start2 + 'subgenu',
-        'Genus': regex_start2 + 'genus',
-        'Superfamily': regex_start2 + 'superfami',
-        'Family': regex_start2 + 'famil',
-        'Subfamily': regex_start2 + 'subfami',
-        'Tribe': regex_start2 + 'tribe',
-        'Subtribe': regex_start2 + 'subtrib',
-        'Class': regex_start2 + 'class',
-        'Subclass': regex_start2 + 'subclas',
-        'Order': regex_start2 + 'order',
-        'Suborder': regex_start2 + 'suborde',
-        'Infraorder': regex_start1 + 'infraorde',
-        'Clade': regex_start2 + 'clade',
-        'Variety': regex_start2 + 'variet',
-        'Species': regex_start2 + 'species',
-        'Informal group': regex_start2 + 'informal group',
-        'Phylum': regex_start1 + 'phylum',
-        'Subphylum': regex_start1 + 'subphylu',
-    }
-    rank = None
+    lead_tokens, regex_sp2 = lead_matchers(name_singular)
 
     # For this function only, just consider the first sentence
     lead_sen = lead_txt.split('.')[0]
     if len(lead_sen) > 26:  # Don't do this if first sentence is unreasonably short
         lead_txt = lead_sen
 
-    # Pre-filter with tight regex of lead_dict1 to extract any obvious match before attempting anything clever
-    for key, val in lead_dict1.items():
-        if re.search(val, lead_txt):  # eg "is a genus ..."
-            rank = key
-            if verbose_stage:
-                print('lead_dict1 lead rank is ', rank)
-            return rank
+    # Single scan for all the tokens. tight_ends holds the positions just after "is a", "is an", "was a" or
+    # "was an"; starts holds the positions just after any "is a", "are a", "was a" or "were a"
+    tight_ends = set()
+    starts = []
+    barriers = [i for i, c in enumerate(lead_txt) if c == '\n'] if '\n' in lead_txt else []
+    hits = []  # (position of keyword, index in lead_ranks)
+    for match in lead_tokens.finditer(lead_txt):
+        group = match.lastgroup
+        if group == 'st1':
+            end = match.end('st1')
+            tight_ends.add(end)
+            if lead_txt[end:end + 1] == 'n':
+                tight_ends.add(end + 1)
+            starts.append(end)
+        elif group == 'st2':
+            starts.append(match.end('st2'))
+        elif group == 'inthe':
+            barriers.append(match.start())
+        else:
+            hits.append((match.start(group), int(group[1:])))
+    barriers.sort()
+
+    # Pre-filter with tight regex (eg "is a genus ...") to extract any obvious match before attempting anything clever
+    tight = [i for pos, i in hits if pos - 1 in tight_ends]
+    if tight:
+        rank = lead_ranks[min(tight)][0]
+        if verbose_stage:
+            print('lead_dict1 lead rank is ', rank)
+        return rank
 
     # Must be Species if lead has eg "Abacetus alesi is a beetle ..."
-    try:
-        regex_sp1 = f'{title_nobra}\s(is\sa|is\san|was\sa|was\san)\s{name_singular}'
-        if re.search(regex_sp1, lead_txt):
-            if verbose_stage:
-                print('regex_sp1 lead match on Species')
-            return 'Species'
-    except re.error:  # Fails if title includes a question mark
-        pass
+    regex_sp1 = rf'{re.escape(title_nobra)}\s(is\sa|is\san|was\sa|was\san)\s{re.escape(name_singular)}'
+    if re.search(regex_sp1, lead_txt):
+        if verbose_stage:
+            print('regex_sp1 lead match on Species')
+        return 'Species'
 
     # Most probably Species if lead has eg " ... is a beetle ..."
-    regex_sp2 = f"(is\sa|is\san|was\sa|was\san)\s{name_singular}"
-    if re.search(regex_sp2, lead_txt):
+    if regex_sp2.search(lead_txt):
         if verbose_stage:
             print('regex_sp2 lead match on Species')
         return 'Species'
 
-    # Work through the options with looser regex of lead_dict2. Return if exactly one rank matches, otherwise None
-    matched = False
-    for key, val in lead_dict2.items():
-        if re.search(val, lead_txt):
-            if verbose_stage:
-                print('lead_dict2 lead matches on ', key)
-            if matched:
-                return None
-            rank = key
-            matched = True
-
-    return rank
+    # Looser match: "is a" + <up to 50 chars not including ' in the' (or a line break)> + <keyword>
+    # Need to ensure that "is an order of fungi in the class Tremellomycetes" maps to 'Order' not Class'
+    # Return if exactly one rank matches, otherwise None
+    matched = set()
+    for pos, i in hits:
+        if lead_ranks[i][2]:
+            if pos - 1 in tight_ends:
+                matched.add(i)
+            continue
+        # The nearest preceding start is the best candidate: if any start qualifies, that one does
+        n = bisect_right(starts, pos - 1)
+        if not n:
+            continue
+        start = starts[n - 1]
+        if pos - 1 - start > 50:
+            continue
+        b = bisect_left(barriers, start)
+        if b < len(barriers) and barriers[b] <= pos - 2:
+            continue
+        matched.add(i)
+    for i in sorted(matched)[:2]:
+        if verbose_stage:
+            print('lead_dict2 lead matches on ', lead_ranks[i][0])
+    if len(matched) == 1:
+        return lead_ranks[matched.pop()][0]
+    return None
 
 
 # Rank from various speciesboxes
-def rank_from_speciesbox(text_compressed):
-    if '{{speciesbox' in text_compressed:
+# taxobox is the record from parse_taxobox
+def rank_from_speciesbox(taxobox):
+    if has_template(taxobox, 'speciesbox'):
         return 'Species'
-    if '{{subspeciesbox' in text_compressed:
+    if has_template(taxobox, 'subspeciesbox'):
         return 'Subspecies'
-    if '{{infraspeciesbox' in text_compressed:
-        var1 = re.search('\|varietas=\w', text_compressed)
-        var2 = re.search('\|variety=\w', text_compressed)
-        if var1 or var2:
+    if has_template(taxobox, 'infraspeciesbox'):
+        if 'varietas' in taxobox['plain'] or 'variety' in taxobox['plain']:
             return 'Variety'
-        subsp = re.search('\|subspecies=\w', text_compressed)
-        if subsp:
+        if 'subspecies' in taxobox['plain']:
             return 'Subspecies'
 
     return None
 
 
-# Rank from general taxobox
-def rank_from_taxobox(title_nobra, text_compressed):
+# Rank from general taxobox. taxobox is the record from parse_taxobox
+def rank_from_taxobox(title_nobra, taxobox):
     match_taxobox_dict = {
         'genus': 'Genus',
         'varietas': 'Variety',
@@ -178,69 +201,68 @@ def rank_from_taxobox(title_nobra, text_compressed):
         'subphylum': 'Subphylum',
     }
 
-    if '{{taxobox' not in text_compressed:
+    if not has_template(taxobox, 'taxobox'):
         return None
+    bold_italic = taxobox['bold_italic']
 
     rank = None
     # Check whether the exact title_nobra is shown in bold italic.
     # If so, that defines the rank (apart from species/subspecies/variety)
     for key, val in match_taxobox_dict.items():
-        to_match = f"|{key}='''''{title_nobra}'''''"  # No match if first part of a binomial is abbreviated
-        if to_match in text_compressed:
+        # No match if first part of a binomial is abbreviated
+        if title_nobra in taxobox['bold_italic_values'].get(key, ()):
             # print ("RETURNING 1")
             return val
 
     # Subspecies and variety. These are in italic only (not bold italic) so two quotation marks
-    if r"|'varietas=''" in text_compressed or r"|'variety=''" in text_compressed:
+    # (The parameter names here and below keep the leading quote mark of the original substring tests)
+    if "'varietas" in taxobox['italic'] or "'variety" in taxobox['italic']:
         rank = 'Variety'
         return rank
-    if r"|'subspecies=''" in text_compressed:
+    if "'subspecies" in taxobox['italic']:
         rank = 'Subspecies'
         return rank
 
     # Check what else is in bold italic
     for key, val in match_taxobox_dict.items():
-        to_match = f"|{key}='''''"  # No match if first part of a binomial is abbreviated
-        if to_match in text_compressed:
+        if key in bold_italic:  # No match if first part of a binomial is abbreviated
             rank = val
 
     # Exceptions for multiple matches
-    if rank == 'Genus' and r"|'subgenus='''''" in text_compressed:
+    if rank == 'Genus' and "'subgenus" in bold_italic:
         rank = 'Subgenus'
         # print("RETURNING 2")
         return rank
-    if rank == 'Family' and r"|'subfamilia='''''" in text_compressed:
+    if rank == 'Family' and "'subfamilia" in bold_italic:
         rank = 'Subfamily'
         # print("RETURNING 3")
         return rank
-    if rank == 'Family' and r"|'superfamilia='''''" in text_compressed:
+    if rank == 'Family' and "'superfamilia" in bold_italic:
         rank = 'Superfamily'
         return rank
-    if rank == 'Tribe' and r"|'subtribus='''''" in text_compressed:
+    if rank == 'Tribe' and "'subtribus" in bold_italic:
         rank = 'Subtribe'
         # print("RETURNING 4")
         return rank
-    if rank == 'Class' and r"|'subclassis='''''" in text_compressed:
+    if rank == 'Class' and "'subclassis" in bold_italic:
         rank = 'Subclass'
         # print("RETURNING 6")
         return rank
-    if rank == 'Order' and r"|'subordo='''''" in text_compressed:
+    if rank == 'Order' and "'subordo" in bold_italic:
         rank = 'Suborder'
         # print("RETURNING 7")
         return rank
 
     # Species/genus oddities
     # Accept species if genus is not in bold
-    if "|genus='''''" not in text_compressed:
-        species_strs = ["|species='''''", "|binomial=''"]  # (only two quote marks for binomial)
-        if any(x in text_compressed for x in species_strs):
+    if 'genus' not in bold_italic:
+        if 'species' in bold_italic or 'binomial' in taxobox['italic']:  # (only two quote marks for binomial)
             rank = "Species"
             # print("RETURNING 8")
             return rank
     # If both genus and species both in bold, probably a monotypic genus
-    if "|genus='''''" in text_compressed:
-        species_strs = ["|species='''''", "|binomial=''"]  # (only two quote marks for binomial)
-        if any(x in text_compressed for x in species_strs):
+    if 'genus' in bold_italic:
+        if 'species' in bold_italic or 'binomial' in taxobox['italic']:  # (only two quote marks for binomial)
             rank = "Genus"
             # print("RETURNING 9")
             return rank
@@ -276,21 +298,23 @@ def info_from_autobox(wikipedia, text_compressed):
         'subphylum': 'Subphylum',
     }
 
-    if '{{automatictaxobox' not in text_compressed:
+    taxon = autobox_taxon(text_compressed)
+    if taxon is None:
         return None, False
 
-    isextinct = False
     try:
-        taxon = find_between(text_compressed, 'taxon=', r'|')
-        taxo_template = f'Template:Taxonomy/{taxon.capitalize()}'
-        taxo_page = pywikibot.Page(wikipedia, taxo_template)
-        taxo_txt_comp = taxo_page.text.lower().replace(' ', '')
-        taxo_rank = find_between(taxo_txt_comp, 'rank=', r'|')
+        taxo_rank, isextinct = taxonomy_info(wikipedia, taxon)  # Template:Taxonomy/<Taxon>
         rank = match_auto_dict[taxo_rank]
-        if '|extinct=yes' in taxo_txt_comp or '|extinct=true' in taxo_txt_comp:
-            isextinct = True
         return rank, isextinct
     except:
         return None, False
 
 
+# The taxon of an Automatictaxobox (capitalized, as in its Template:Taxonomy title), or None if there isn't one
+def autobox_taxon(text_compressed):
+    if '{{automatictaxobox' not in text_compressed:
+        return None
+    try:
+        return find_between(text_compressed, 'taxon=', r'|').capitalize()
+    except:
+        return None
@@ -6,6 +6,8 @@
 # https://bitbucket.org/mikepeel/wikicode/src/master/shortdesc_functions.py
 # 2020–21. Latest update 27 February 2021
 
+import sys
+
 from sd_add import *
 from sd_stage import *
 
@@ -13,22 +15,30 @@ from sd_stage import *
 wikipedia = pywikibot.Site('en', 'wikipedia')
 username = pywikibot.config.usernames['wikipedia']['en']
 
-# Run staging code
-if mode_flag == 'stage':
-    print('\nLogged in as ' + username)
-    if write_wp_examples:
-        print(f'Will write up to {max_examples} examples to my Wikipedia userspace\n')
-    if use_basefile:
-        input(f'***** Ready to stage from {base_file}. Press return to continue\n')
-    else:
-        input(f'***** Ready to stage from {targetcat}. Press return to continue\n')
-    shortdesc_stage()
+# Only when run as the main program, not when imported by the staging worker processes
+if __name__ == '__main__':
+    # Run staging code. With --resume, carry on from where an unfinished run stopped
+    if mode_flag == 'stage':
+        resume = '--resume' in sys.argv
+        print('\nLogged in as ' + username)
+        if write_wp_examples:
+            print(f'Will write up to {max_examples} examples to my Wikipedia userspace\n')
+        action = 'resume staging' if resume else 'stage'
+        if use_dump:
+            input(f'***** Ready to {action} from {dump_file}. Press return to continue\n')
+        elif use_basefile:
+            input(f'***** Ready to {action} from {base_file}. Press return to continue\n')
+        else:
+            input(f'***** Ready to {action} from {targetcat}. Press return to continue\n')
+        shortdesc_stage(resume)
 
-# Run live editing code
-if mode_flag == 'edit':
-    print('\nLogged in as ' + username)
-    run_type = 'assisted' if assisted_mode else 'automatic'
-    if override_manual or override_embedded:
-        print('WARNING: the bot may change existing descriptions')
-    input(f'***** READY TO WRITE LIVE EDITS in {run_type} mode. Press return to continue\n')
-    shortdesc_add()
+    # Run live editing code. With --resume, carry on from where an unfinished run stopped
+    if mode_flag == 'edit':
+        resume = '--resume' in sys.argv
+        print('\nLogged in as ' + username)
+        run_type = 'assisted' if assisted_mode else 'automatic'
+        if override_manual or override_embedded:
+            print('WARNING: the bot may change existing descriptions')
+        resuming = f', resuming from {edit_journal}' if resume else ''
+        input(f'***** READY TO WRITE LIVE EDITS in {run_type} mode{resuming}. Press return to continue\n')
+        shortdesc_add(resume)
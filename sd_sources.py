@@ -0,0 +1,50 @@
+# See sd_run.py for status and copyright release information
+
+from sd_category import get_category_tree
+from sd_config import *
+
+
+# Sources of pages for staging. Each yields (cursor, page) pairs, where cursor (a dict that can be saved as JSON) marks
+# the position in the source just after page. Passing a saved cursor back in carries on from that position, without
+# reading or fetching anything before it
+
+
+# Pages listed in a base_file (Petscan tsv), read one line at a time. The cursor holds the byte offset of the next line
+def basefile_pages(base_file, cursor=None):
+    for offset, title in basefile_titles(base_file, cursor['offset'] if cursor else 0):
+        yield {'offset': offset}, pywikibot.Page(wikipedia, title)
+
+
+# The titles in a base_file, from byte offset start, as (offset of the next line, title) pairs
+# A title quoted in full, as Petscan quotes it (eg "Aus ""bus""" for Aus "bus"), is unquoted. Any other title is read
+# as it is, so that titles written unquoted by staging (eg "Weird Al" Yankovic) come back unchanged
+def basefile_titles(base_file, start=0):
+    with open(base_file, 'rb') as f:
+        f.seek(start)
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            values = line.decode('utf-8').rstrip('\r\n').split('\t')
+            if len(values) < 2 or values[0] == 'number':  # Ignore any header line, and blank lines
+                continue
+            yield f.tell(), unquote_title(values[1])  # Column 0 is a sequence number
+
+
+# Unquote a title if it is quoted in full: in quote marks, with any quote marks inside it doubled
+def unquote_title(title):
+    if len(title) >= 2 and title.startswith('"') and title.endswith('"') and '"' not in title[1:-1].replace('""', ''):
+        return title[1:-1].replace('""', '"')
+    return title
+
+
+# Articles in a category and, if recurse, its subcategories, from the saved category tree (see sd_category.py)
+# The cursor holds the position in the tree's member list. When resuming, the saved tree is used whatever its age, so
+# the positions match
+def category_pages(cat_title, recurse, cursor=None):
+    tree = get_category_tree(wikipedia, cat_title, recurse, any_age=cursor is not None)
+    if cursor and cursor.get('walked') != tree['walked']:
+        print('WARNING: The category tree has changed since the checkpoint. Resuming at the same position anyway')
+    start = cursor['index'] + 1 if cursor else 0
+    for index in range(start, len(tree['members'])):
+        yield {'walked': tree['walked'], 'index': index}, pywikibot.Page(wikipedia, tree['members'][index])
@@ -1,132 +1,189 @@
 # See sd_run.py for status and copyright release information
 
 import datetime
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-from pywikibot import pagegenerators
-
+from sd_async import stop_client
+from sd_dump import dump_fetch, dump_pages, scan_dump_taxonomy
+from sd_fetch import RecordPage, fetch_full_text, fetch_pages, fetched, resolve_titles
 from sd_functions import *
 from sd_generator import shortdesc_generator
-from sd_get_lead import get_lead
+from sd_get_lead import get_lead, lead_section
+from sd_rank_from import autobox_taxon
+from sd_sources import basefile_pages, category_pages
+from sd_taxonomy import refresh_taxonomy_store, save_taxonomy_store, taxonomy, taxonomy_info, taxonomy_state
+
+# Number of rows written to the staging output in this run
+staging_state = {'rows': 0}
 
 
 # Main function for 'stage' mode
 # Calls check_page, check_criteria and shortdesc_generator
-def shortdesc_stage():
+# If resume, carry on from the checkpoint left by an earlier run that did not finish
+def shortdesc_stage(resume=False):
     count_arts = count_success = count_success_examples = count_failure = 0
-    staging_str = success_examples_str = ''
-    tripped = False
-
-    # Set up pages as iterable, from cat or from Petscan file. Each item in pages must be created as a Pywikibot object
-    if use_basefile:  # Import a file of Petscan results
-        pages = []
-        with open(base_file) as f:
-            data = f.read()
-            todo = data.splitlines()
-        for line in todo:
-            values = line.split('\t')
-            if values[0] == 'number':  # Ignore any header line
-                continue
-            title = values[1]  # Column 0 is a sequence number
-            page = pywikibot.Page(wikipedia, title)
-            pages.append(page)
+    success_examples_str = ''
+    source = dump_file if use_dump else base_file if use_basefile else targetcat
+
+    checkpoint = None
+    if resume:
+        checkpoint = load_checkpoint()
+        if checkpoint is None:
+            print(f'\nSTOPPING: No checkpoint to resume from in {staging_checkpoint}')
+            return
+        if checkpoint['source'] != source:
+            print(f'\nSTOPPING: {staging_checkpoint} is for {checkpoint["source"]}, not {source}')
+            return
+        count_arts, count_success, count_success_examples, count_failure = checkpoint['counts']
+        success_examples_str = checkpoint['examples']
+        filter_rejects.update(checkpoint['rejects'])
+        print(f'Resuming after {count_arts} articles ({count_success} staged)')
 
+    if refresh_taxonomy:
+        refresh_taxonomy_store(wikipedia)
+    if use_dump:  # So that staging from the dump needs no taxonomy lookups
+        scan_dump_taxonomy(dump_file)
+
+    # Set up pages as iterable of (cursor, page), from dump, cat or Petscan file. Each page is a Pywikibot object
+    cursor = checkpoint['cursor'] if checkpoint else None
+    if use_dump:  # Read the pages from a local dump
+        pages = dump_pages(dump_file, dump_title_regex, cursor)
+    elif use_basefile:  # Import a file of Petscan results
+        pages = basefile_pages(base_file, cursor)
     else:  # Use articles in the Wikipedia category
-        cat = pywikibot.Category(wikipedia, targetcat)
-        pages = pagegenerators.CategorizedPageGenerator(cat, recurse=recurse_cats, namespaces=[0])
+        pages = category_pages(pywikibot.Category(wikipedia, targetcat).title(), recurse_cats, cursor)
 
-    # Main loop
-    for page in pages:
-        lead_text = get_lead(page)
-        title = clean_title(page.title())
+    # Staged rows are written as they are produced, to a temporary file that is renamed when the run is finished
+    # If the run is interrupted, the rows staged so far are kept in the temporary file
+    staging_state['rows'] = 0
+    if checkpoint:  # Carry on with the same file, dropping anything written after the checkpoint
+        dt_extension = checkpoint['dt_extension']
+        staging_partial = checkpoint['output']
+        try:
+            os.truncate(staging_partial, checkpoint['offset'])
+            staging_out = open(staging_partial, 'a')
+        except:
+            print(f'\nSTOPPING: Unable to reopen {staging_partial}')
+            return
+    else:
+        now = datetime.datetime.now()
+        dt_extension = f'{now:%Y-%m-%d (%H %M)}'
+        staging_partial = staging_file.split('.')[0] + ' (in progress) ' + dt_extension + '.tsv'
+        try:
+            staging_out = open(staging_partial, 'w')
+        except:
+            print(f'\nSTOPPING: Unable to open {staging_partial}')
+            return
 
-        # If partial is True, skip over initial pages until we reach the startpoint
-        if partial and not tripped:
-            at_startpoint = startpoint in title
-            tripped = at_startpoint
-            if not at_startpoint:
+    checkpoint_pages = 0
+    results = None
+    try:
+        # Main loop. Pages are fetched in batches, and each record carries the page's text, pageprops and categories
+        # Pages that can be rejected on their title alone, redirects and duplicates are dropped before they are fetched
+        # Results come back in input order, whether pages are classified here or in worker processes
+        # Pages from a dump already carry their text, and the dump's redirects have been left out
+        # Each record carries the source cursor of its page
+        if use_dump:
+            records = dump_fetch(screen_titles(pages, bool(checkpoint)))
+        else:
+            records = fetch_targets(resolve_targets(screen_titles(pages, bool(checkpoint))))
+        if stage_processes:  # Classify pages in worker processes, while the next pages are being fetched
+            results = classify_records_pipeline(records)
+        else:
+            results = classify_records(records)
+        for record, skip_text, outcome in results:
+            # Everything before this page is finished. Note where to resume from, and save that every so often
+            checkpoint = {'source': source,
+                          'cursor': cursor,
+                          'counts': [count_arts, count_success, count_success_examples, count_failure],
+                          'examples': success_examples_str,
+                          'rejects': dict(filter_rejects),
+                          'output': staging_partial,
+                          'dt_extension': dt_extension,
+                          'offset': staging_out.tell()}
+            checkpoint_pages += 1
+            if checkpoint_pages >= staging_flush_rows:
+                save_checkpoint(checkpoint, staging_out)
+                checkpoint_pages = 0
+
+            page = record['page']
+            title = clean_title(page.title())
+            cursor = record['cursor']
+
+            if skip_text:   # Should we skip this page? (not recorded in the list of failures)
+                print(title + ' - Skipped: ' + skip_text)
                 continue
 
-        if verbose_stage:
-            print('\nCHECKING PAGE  - ', title)
+            # OK, now process this page
+            count_arts += 1
+            result, description, wikidata_sd, lead_text = outcome
 
-        # Do we want this page? Check against page definition
-        result_page, skip_text = check_page(page)
-        if not result_page:   # Should we skip this page? (not recorded in the list of failures)
-            print(title + ' - Skipped: ' + skip_text)
-            continue
+            # If we have not been able to extract a lead, write failure line to the staging output
+            if lead_text is None:
+                print(str(count_arts) + ': ' + title + ' - FAILED: ' + description)
+                count_failure += 1
+                write_staged_row(staging_out,
+                                 [count_arts, title, description, wikidata_sd, '[None]'] + revision_values(record))
+                if stop_now(max_arts, count_arts):
+                    break
+                continue
 
-        # OK, now process this page
-        count_arts += 1
-
-        # If we have not been able to extract a lead, write failure line to staging_str
-        if lead_text is None:
-            print(str(count_arts) + ': ' + title + ' - FAILED: Could not extract lead')
-            errortext = 'Could not extract lead'
-            count_failure += 1
-            staging_str += str(
-                count_arts) + '\t' + title + '\t' + errortext + '\t' + wikidata_sd + '\t' + '[None]' + '\n'
-            if stop_now(max_arts, count_arts):
-                break
-            continue
+            # If the page fails the criteria, or nothing usable is generated, write failure line to the staging output
+            if not result:
+                print(str(count_arts) + ': ' + title + ' - FAILED: ' + description)
+                count_failure += 1
+                write_staged_row(staging_out,
+                                 [count_arts, title, description, wikidata_sd, lead_text] + revision_values(record))
+                if stop_now(max_arts, count_arts):
+                    break
+                continue
 
-        # We have a page to work with. Check against the criteria and get Wikidata SD (for reference only)
-        result_criteria, errortext = check_criteria(page, lead_text)
-        wikidata_sd = get_wikidata_desc(page)
-
-        # If the page fails, write failure line to staging_str
-        if not result_criteria:
-            print(str(count_arts) + ': ' + title + ' - FAILED: ' + errortext)
-            count_failure += 1
-            staging_str += str(
-                count_arts) + '\t' + title + '\t' + errortext + '\t' + wikidata_sd + '\t' + lead_text + '\n'
-            if stop_now(max_arts, count_arts):
-                break
-            continue
+            # We have a good draft description!
+            count_success += 1
+            print(str(count_arts) + ': ' + title + f' - STAGING NEW SD {count_success}: ' + description)
 
-        # The page matches - work out a new short description
-        result_gen, description = shortdesc_generator(page, lead_text)
-        if not result_gen:  # If nothing usable, write failure line to staging_str
-            print(str(count_arts) + ': ' + title + ' - FAILED: ' + description)
-            count_failure += 1
-            staging_str += str(
-                count_arts) + '\t' + title + '\t' + description + '\t' + wikidata_sd + '\t' + lead_text \
-                           + '\n'
-            if stop_now(max_arts, count_arts):
-                break
-            continue
+            # Add to the staging output
+            write_staged_row(staging_out,
+                             [count_arts, title, description, wikidata_sd, lead_text] + revision_values(record))
+            #  If needed, also build up success_examples_str string ready to write to userspace
+            if write_wp_examples and count_success_examples <= max_examples:
+                count_success_examples += 1
+                success_examples_str += '|-\n'
+                success_examples_str += '| [[' + title + ']] || ' + description + ' || ''' + wikidata_sd + ' || ' \
+                                        + lead_text + '\n'
 
-        # We have a good draft description!
-        count_success += 1
-        print(str(count_arts) + ': ' + title + f' - STAGING NEW SD {count_success}: ' + description)
-
-        # Add to staging_str
-        staging_str += str(
-            count_arts) + '\t' + title + '\t' + description + '\t' + wikidata_sd + '\t' + lead_text + '\n'
-        #  If needed, also build up success_examples_str string ready to write to userspace
-        if write_wp_examples and count_success_examples <= max_examples:
-            count_success_examples += 1
-            success_examples_str += '|-\n'
-            success_examples_str += '| [[' + title + ']] || ' + description + ' || ''' + wikidata_sd + ' || ' \
-                                    + lead_text + '\n'
-
-        if stop_now(max_arts, count_arts) or stop_now(max_stage, count_success):
-            break
-        if partial and tripped:  # If partial is True, stop when we reach the endpoint
-            at_endpoint = endpoint in title
-            if at_endpoint:
+            if stop_now(max_arts, count_arts) or stop_now(max_stage, count_success):
+                break
+            if partial and endpoint in title:  # If partial is True, stop when we reach the endpoint
                 break
+    except BaseException:  # Including KeyboardInterrupt
+        if checkpoint:
+            save_checkpoint(checkpoint, staging_out)
+        print(f'\nINTERRUPTED: Rows staged so far are in {staging_partial}. Run with --resume to carry on')
+        raise
+    finally:
+        if results is not None:  # Stop any worker processes, and the fetching, if the loop ended early
+            results.close()
+        close_staging_output(staging_out)
+        save_taxonomy_store()  # Keep any taxonomy templates fetched during this run
+        stop_client()
+    print_filter_rejects()
 
-    # Finished creating staging_str. Now stage to staged_output
-    if staging_str:
-        try:
-            now = datetime.datetime.now()
-            dt_extension = f'{now:%Y-%m-%d (%H %M)}'
-            staged_output = staging_file.split('.')[0] + f' ({count_success} of {count_arts}) ' + dt_extension + '.tsv'
-            with open(staged_output, 'w') as f1:
-                f1.write(staging_str)
-        except:
-            print(f'\nSTOPPING: Unable to open {staged_output}')
-            return
+    remove_checkpoint()
+
+    # Finished staging. Now give the staging output its final name
+    staged_output = staging_file.split('.')[0] + f' ({count_success} of {count_arts}) ' + dt_extension + '.tsv'
+    try:
+        if count_arts:
+            os.replace(staging_partial, staged_output)
+        else:
+            os.remove(staging_partial)
+    except:
+        print(f'\nWARNING: Unable to rename {staging_partial} to {staged_output}')
+        staged_output = staging_partial
 
     # Write examples to my userspace, if requested
     if write_wp_examples and success_examples_str:
@@ -151,3 +208,257 @@ def shortdesc_stage():
     except:
         print('\nNo target articles found')
     return
+
+
+# Screen pages on their titles alone, before they are fetched: the partial startpoint, then the page filters that need
+# only the title or a local index
+# pages is an iterable of (cursor, page), and so are the pages passed on
+# tripped is True if the startpoint has already been reached (eg when resuming)
+def screen_titles(pages, tripped=False):
+    for cursor, page in pages:
+        title = clean_title(page.title())
+
+        # If partial is True, skip over initial pages until we reach the startpoint
+        if partial and not tripped:
+            tripped = startpoint in title
+            if not tripped:
+                continue
+
+        result_page, skip_text = check_page(page, ('title', 'index'))
+        if not result_page:
+            print(title + ' - Skipped: ' + skip_text)
+            continue
+        yield cursor, page
+
+
+# Fetch the pages passed on by resolve_targets, as fetch_pages does. Each record is given its page's source cursor
+# fetch_pages yields one record per page, in input order, so the cursors are matched up in the same order
+def fetch_targets(targets):
+    cursors = deque()
+
+    def target_pages():
+        for cursor, page in targets:
+            cursors.append(cursor)
+            yield page
+
+    for record in fetch_pages(target_pages(), lead_only=fetch_lead_only, wikidata=use_wikidata):
+        record['cursor'] = cursors.popleft()
+        yield record
+
+
+# Check a fetched page against the page definition, unless it was rejected on its title. Returns the reason to skip it,
+# or '' if it should be classified
+def screen_record(record):
+    if verbose_stage:
+        print('\nCHECKING PAGE  - ', clean_title(record['title']))
+    return check_page(record['page'], ('text', 'network'))[1]  # The title and index filters have already been run
+
+
+# Classify a page that has passed check_page. Returns (result, description or error text, Wikidata SD, lead text)
+# where result is True for a good draft description. The lead text is None if no lead could be extracted
+# If section_0 (the page text is only section 0 of an existing page) and there is no lead, returns None instead, so
+# that the page can be tried again with its full text
+def classify_page(page, section_0=False):
+    lead_text = get_lead(page)
+    if lead_text is None:
+        return False, 'Could not extract lead', '', None
+    if not lead_text and section_0:
+        return None
+
+    # We have a page to work with. Check against the criteria and get Wikidata SD (for reference only)
+    result_criteria, errortext = check_criteria(page, lead_text)
+    wikidata_sd = get_wikidata_desc(page)
+    if not result_criteria:
+        return False, errortext, wikidata_sd, lead_text
+
+    # The page matches - work out a new short description
+    result_gen, description = shortdesc_generator(page, lead_text)
+    return result_gen, description, wikidata_sd, lead_text
+
+
+# Classify fetched records one at a time. Yields (record, skip text, outcome) in input order
+def classify_records(records):
+    for record in records:
+        skip_text = screen_record(record)
+        if skip_text:
+            yield record, skip_text, None
+            continue
+        page = record['page']
+        outcome = classify_page(page, record['lead_only'] and not record['missing'])
+        if outcome is None:  # Try again with the full text
+            fetch_full_text(record)
+            outcome = classify_page(page)
+        yield record, '', outcome
+
+
+# Classify fetched records in stage_processes worker processes. Yields (record, skip text, outcome) in input order,
+# exactly as classify_records does. Up to stage_queue_size records are in flight, so this process fetches the next
+# pages while the workers classify the previous ones. Workers are sent plain dicts (see plain_record), not pywikibot
+# objects, and make no API requests
+# If the caller stops early, close the generator: the pages not yet started are then dropped, and the workers stopped
+def classify_records_pipeline(records):
+    window = deque()
+    with ProcessPoolExecutor(max_workers=stage_processes, initializer=init_stage_worker) as pool:
+        try:
+            for record in records:
+                skip_text = screen_record(record)
+                if skip_text:
+                    window.append((record, skip_text, None))
+                else:
+                    window.append((record, '', pool.submit(classify_item, plain_record(record))))
+                if len(window) >= stage_queue_size:
+                    yield pipeline_result(*window.popleft())
+            while window:
+                yield pipeline_result(*window.popleft())
+        finally:  # Drop the pages not yet started, if stopped early (cancel_futures needs Python 3.9)
+            for record, skip_text, future in window:
+                if future is not None:
+                    future.cancel()
+
+
+# Wait for a record's outcome from the workers, and finish it off here if it needs the full text
+def pipeline_result(record, skip_text, future):
+    if future is None:
+        return record, skip_text, None
+    outcome, rejects = future.result()
+    filter_rejects.update(rejects)
+    if outcome is None:  # Try again with the full text, in this process
+        fetched[record['title']] = record
+        fetch_full_text(record)
+        outcome = classify_page(record['page'])
+    return record, '', outcome
+
+
+# The plain data a worker needs to classify a page: the page record without its Page object. Everything that needs
+# pywikibot, the network or a local index is worked out here: the visible categories, the Wikidata description,
+# section 0 of the text (extract_sections reads the site's namespaces), and the taxonomy template (if any) used by
+# its Automatictaxobox
+def plain_record(record):
+    record_categories(record)
+    record['wikidata_desc'] = get_wikidata_desc(record['page'])
+    item = {key: value for key, value in record.items() if key != 'page'}
+    item['section_0'] = lead_section(record['text'])
+    taxon = autobox_taxon(record['text'].lower().replace(' ', ''))
+    item['taxonomy'] = {}
+    if taxon:
+        taxonomy_info(wikipedia, taxon)  # Fetched into the store here if not already there
+        if taxon in taxonomy:
+            item['taxonomy'][taxon] = taxonomy[taxon]
+    return item
+
+
+# Set up a worker process. The taxonomy entries each page needs are sent with it, so the store is never read or fetched
+def init_stage_worker():
+    taxonomy_state['loaded'] = True
+    taxonomy_state['complete'] = True
+
+
+# Classify a page in a worker process, from its plain record. Returns (outcome, filter rejects counted)
+def classify_item(item):
+    record = dict(item)
+    record['page'] = RecordPage(record['title'])
+    fetched.clear()
+    fetched[record['title']] = record
+    taxonomy.update(item['taxonomy'])
+    filter_rejects.clear()
+    outcome = classify_page(record['page'], record['lead_only'] and not record['missing'])
+    return outcome, dict(filter_rejects)
+
+
+# Resolve redirects and drop duplicate targets before pages are fetched, fetch_batch_size titles per request
+# Redirects are skipped, or replaced by their targets if follow_redirects. Pages that do not exist, are not articles
+# or have already been passed on (by page id) are skipped. Each skip is counted in filter_rejects
+# pages is an iterable of (cursor, page), and so are the pages passed on
+def resolve_targets(pages):
+    seen = set()
+    batch = []
+    for cursor, page in pages:
+        batch.append((cursor, page))
+        if len(batch) >= fetch_batch_size:
+            yield from resolve_batch(batch, seen)
+            batch = []
+    if batch:
+        yield from resolve_batch(batch, seen)
+
+
+def resolve_batch(batch, seen):
+    resolved = resolve_titles([page.title() for cursor, page in batch])
+    for cursor, page in batch:
+        title = page.title()
+        info, target = resolved[title]
+        reason = name = ''
+        if target is not None and not follow_redirects:
+            reason, name = 'Is a redirect', 'redirect'
+        elif info.get('missing') or info.get('invalid'):
+            reason, name = 'Does not exist', 'missing'
+        elif info.get('ns') != 0:
+            reason, name = 'Not an article', 'not an article'
+        elif info['pageid'] in seen:
+            reason, name = 'Duplicate of ' + info['title'], 'duplicate'
+        elif target is not None:  # Check the target's title too (check_page counts any rejection)
+            page = pywikibot.Page(wikipedia, target)
+            reason = check_page(page, ('title', 'index'))[1]
+        if reason:
+            if name:
+                filter_rejects[name] += 1
+            print(clean_title(title) + ' - Skipped: ' + reason)
+            continue
+        seen.add(info['pageid'])
+        yield cursor, page
+
+
+# Read the staging checkpoint, if there is one
+def load_checkpoint():
+    if not os.path.exists(staging_checkpoint):
+        return None
+    try:
+        with open(staging_checkpoint, encoding='utf-8') as f:
+            return json.load(f)
+    except:
+        print(f'WARNING: Unable to read {staging_checkpoint}')
+        return None
+
+
+# Push the staging output through to disk, then save the checkpoint that goes with it
+def save_checkpoint(checkpoint, staging_out):
+    try:
+        staging_out.flush()
+        os.fsync(staging_out.fileno())
+        with open(staging_checkpoint + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(staging_checkpoint + '.tmp', staging_checkpoint)
+    except:
+        print(f'WARNING: Unable to write {staging_checkpoint}')
+
+
+# Remove the staging checkpoint once the run is finished
+def remove_checkpoint():
+    try:
+        if os.path.exists(staging_checkpoint):
+            os.remove(staging_checkpoint)
+    except:
+        print(f'WARNING: Unable to remove {staging_checkpoint}')
+
+
+# Write one row to the staging output. Every staging_flush_rows rows, push it through to disk
+def write_staged_row(staging_out, values):
+    staging_out.write('\t'.join(str(value) for value in values) + '\n')
+    staging_state['rows'] += 1
+    if staging_state['rows'] % staging_flush_rows == 0:
+        staging_out.flush()
+        os.fsync(staging_out.fileno())
+
+
+# The revision id and content hash (sha1) of the staged page, written after the lead. Edit mode skips re-checking
+# pages that have not changed since they were staged
+def revision_values(record):
+    return [record['revid'] or '', record['sha1'] or '']
+
+
+# Flush the staging output to disk and close it
+def close_staging_output(staging_out):
+    try:
+        staging_out.flush()
+        os.fsync(staging_out.fileno())
+    finally:
+        staging_out.close()
@@ -0,0 +1,122 @@
+# See sd_run.py for status and copyright release information
+
+# Stand-in for the MediaWiki API on loopback, for measuring the staging reads without touching the live wiki.
+# Not part of the bot itself. Answers the queries the bot reads pages and taxonomy templates with. Article texts are
+# taken from a corpus directory (as saved by 'python sd_bench.py save') or, without one, made up
+# Usage:
+#   python sd_standin.py [--port 8765] [--corpus <dir>] [--latency <ms>] [--lag <fraction of requests>]
+# then set async_api_url = 'http://127.0.0.1:8765/w/api.php', or run 'python sd_bench.py fetch <base file> <url>'
+
+import json
+import os
+import random
+import sys
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+standin = {'texts': [], 'latency': 0.0, 'lag': 0.0, 'requests': 0}
+
+
+# The text of an article: from the corpus if there is one (chosen by title, so always the same), otherwise made up
+def article_text(title):
+    if standin['texts']:
+        return standin['texts'][zlib.crc32(title.encode('utf-8')) % len(standin['texts'])]
+    return "{{Speciesbox\n| genus = Aus\n| species = bus\n}}\n'''" + title + "''' is a species of alga.\n\n" \
+           "== Description ==\n" + 'Lorem ipsum. ' * 200 + '\n\n[[Category:Algae]]\n'
+
+
+# The page entry for one title, as the API returns it with formatversion=2
+def page_entry(title, params):
+    pageid = zlib.crc32(title.encode('utf-8')) % 10000000 + 1
+    ns = 10 if title.startswith('Template:') else 0
+    entry = {'pageid': pageid, 'ns': ns, 'title': title}
+    props = params.get('prop', '').split('|')
+    if 'info' in props:
+        entry['lastrevid'] = pageid
+    if 'revisions' in props:
+        if title.startswith('Template:Taxonomy/'):
+            text = '{{Don\'t edit this line {{{machine code|}}}\n|rank=genus\n|link=' + title.split('/', 1)[1] + \
+                   '\n|parent=Aus\n}}'
+        else:
+            text = article_text(title)
+            if params.get('rvsection') == '0':
+                heading = text.find('\n==')
+                text = text if heading == -1 else text[:heading]
+        entry['revisions'] = [{'revid': pageid, 'slots': {'main': {'contentmodel': 'wikitext', 'content': text}}}]
+    if 'pageprops' in props and ns == 0:
+        entry['pageprops'] = {'wikibase_item': f'Q{pageid}'}
+    if 'categories' in props and ns == 0:
+        entry['categories'] = [{'ns': 14, 'title': 'Category:Algae'}]
+    return entry
+
+
+# Answer one API request (params are single values)
+def answer(params):
+    if standin['lag'] and random.random() < standin['lag']:
+        return {'error': {'code': 'maxlag', 'info': 'Waiting for a database server: 6 seconds lagged.', 'lag': 6}}, \
+               {'Retry-After': '1'}
+    if params.get('action') != 'query' or 'titles' not in params:
+        return {'error': {'code': 'badvalue', 'info': 'The stand-in only answers title queries'}}, {}
+    pages = [page_entry(title, params) for title in params['titles'].split('|')]
+    return {'batchcomplete': True, 'query': {'pages': pages}}, {}
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive
+
+    def do_GET(self):
+        self.respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.respond(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+    def respond(self, query):
+        standin['requests'] += 1
+        if standin['latency']:
+            time.sleep(standin['latency'])
+        result, headers = answer({key: values[0] for key, values in query.items()})
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve on loopback until interrupted
+def serve(port=8765):
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandinHandler)
+    print(f'Stand-in API at http://127.0.0.1:{port}/w/api.php ({len(standin["texts"])} corpus texts)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f'\n{standin["requests"]} requests answered')
+    return server
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    port = 8765
+    while args:
+        option = args.pop(0)
+        if option == '--port':
+            port = int(args.pop(0))
+        elif option == '--corpus':
+            corpus_dir = args.pop(0)
+            for name in sorted(os.listdir(corpus_dir)):
+                if name.endswith('.txt'):
+                    with open(os.path.join(corpus_dir, name), encoding='utf-8') as f:
+                        standin['texts'].append(f.read())
+        elif option == '--latency':
+            standin['latency'] = float(args.pop(0)) / 1000
+        elif option == '--lag':
+            standin['lag'] = float(args.pop(0))
+    serve(port)
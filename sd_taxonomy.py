@@ -0,0 +1,147 @@
+# See sd_run.py for status and copyright release information
+
+import json
+import os
+
+from pywikibot.data import api
+
+from sd_async import api_query, run, submit
+from sd_config import *
+from sd_functions import find_between
+
+# Template:Taxonomy store, keyed by taxon (the title after 'Template:Taxonomy/'). Loaded from taxonomy_store on
+# first use. Each entry is [rank, isextinct, revid]. Templates that do not exist are stored with revid 0
+# If offline (when staging from a dump), taxa missing from the store are never fetched. dump is [file name, modified
+# time] of the dump whose taxonomy templates were last read into the store, if any
+taxonomy = {}
+taxonomy_state = {'loaded': False, 'complete': False, 'changed': False, 'offline': False, 'dump': None}
+
+
+# Read the taxonomy store from disk, if there is one
+def load_taxonomy_store():
+    taxonomy_state['loaded'] = True
+    if not os.path.exists(taxonomy_store):
+        return
+    try:
+        with open(taxonomy_store, encoding='utf-8') as f:
+            data = json.load(f)
+        taxonomy.update(data['taxa'])
+        taxonomy_state['complete'] = data.get('complete', False)
+        taxonomy_state['dump'] = data.get('dump')
+    except:
+        print(f'WARNING: Unable to read {taxonomy_store}. Starting with an empty taxonomy store')
+
+
+# Write the taxonomy store to disk, if anything has changed
+def save_taxonomy_store():
+    if not taxonomy_state['changed']:
+        return
+    try:
+        with open(taxonomy_store + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'complete': taxonomy_state['complete'], 'dump': taxonomy_state['dump'], 'taxa': taxonomy}, f)
+        os.replace(taxonomy_store + '.tmp', taxonomy_store)
+        taxonomy_state['changed'] = False
+    except:
+        print(f'WARNING: Unable to write {taxonomy_store}')
+
+
+# Get rank (lower case, as written in the template) and extinct status from the text of a taxonomy template
+def parse_taxonomy(text):
+    taxo_txt_comp = text.lower().replace(' ', '')
+    try:
+        taxo_rank = find_between(taxo_txt_comp, 'rank=', r'|')
+    except IndexError:
+        taxo_rank = ''
+    isextinct = '|extinct=yes' in taxo_txt_comp or '|extinct=true' in taxo_txt_comp
+    return taxo_rank, isextinct
+
+
+# Return (rank, isextinct) for taxon, or None if there is no such taxonomy template
+# Reads the store with no network access. Only taxa missing from an incomplete store are fetched from the wiki, and
+# not even those if offline
+def taxonomy_info(site, taxon):
+    if not taxonomy_state['loaded']:
+        load_taxonomy_store()
+    if taxon not in taxonomy and not taxonomy_state['complete'] and not taxonomy_state['offline']:
+        fetch_taxonomy(site, [taxon])
+    entry = taxonomy.get(taxon)
+    if entry is None or not entry[2]:
+        return None
+    return entry[0], entry[1]
+
+
+# Fetch the taxonomy templates for taxa, 50 at a time, and add them to the store
+def fetch_taxonomy(site, taxa):
+    chunks = [taxa[i:i + 50] for i in range(0, len(taxa), 50)]
+    queries = [{'action': 'query',
+                'format': 'json',
+                'formatversion': 2,
+                'prop': 'revisions',
+                'rvprop': 'ids|content',
+                'rvslots': 'main',
+                'titles': '|'.join('Template:Taxonomy/' + taxon for taxon in chunk)} for chunk in chunks]
+    for chunk, items in zip(chunks, query_many(site, queries)):
+        for item in items:
+            taxon = item['title'].split('/', 1)[1]
+            if item.get('missing') or not item.get('revisions'):
+                taxonomy[taxon] = [None, False, 0]
+                continue
+            revision = item['revisions'][0]
+            taxo_rank, isextinct = parse_taxonomy(revision['slots']['main'].get('content', ''))
+            taxonomy[taxon] = [taxo_rank, isextinct, revision['revid']]
+        for taxon in chunk:  # Record anything the API did not return as missing, so we don't ask again
+            taxonomy.setdefault(taxon, [None, False, 0])
+        taxonomy_state['changed'] = True
+
+
+# Fill or refresh the whole store by enumerating the Template:Taxonomy/ prefix
+# Only templates that are new, or whose revision id has changed since the last refresh, have their text fetched
+def refresh_taxonomy_store(site):
+    if not taxonomy_state['loaded']:
+        load_taxonomy_store()
+    print('Refreshing taxonomy store ...')
+    params = {'action': 'query',
+              'format': 'json',
+              'formatversion': 2,
+              'generator': 'allpages',
+              'gapnamespace': 10,
+              'gapprefix': 'Taxonomy/',
+              'gaplimit': 'max',
+              'prop': 'info'}
+    current = {}
+    for item in query_pages(site, params):
+        current[item['title'].split('/', 1)[1]] = item['lastrevid']
+    changed = [taxon for taxon, revid in current.items() if taxon not in taxonomy or taxonomy[taxon][2] != revid]
+    for taxon in [taxon for taxon in taxonomy if taxon not in current]:  # Deleted or never existed
+        del taxonomy[taxon]
+    fetch_taxonomy(site, changed)
+    taxonomy_state['complete'] = True
+    taxonomy_state['changed'] = True
+    save_taxonomy_store()
+    print(f'Taxonomy store has {len(taxonomy)} templates ({len(changed)} fetched)')
+
+
+# Run a query, following continuations, and yield the page entries from every result
+def query_pages(site, params):
+    if async_reads:
+        for result in run(api_query(params)):
+            yield from result.get('query', {}).get('pages', [])
+        return
+    params = dict(params)
+    while True:
+        result = api.Request(site=site, parameters=params).submit()
+        yield from result.get('query', {}).get('pages', [])
+        if 'continue' not in result:
+            break
+        params.update(result['continue'])
+
+
+# Run several queries and yield a list of the page entries from each, in order. If async_reads, they run at once
+def query_many(site, queries):
+    if async_reads:
+        futures = [submit(api_query(params)) for params in queries]
+        for future in futures:
+            yield [item for result in future.result() for item in result.get('query', {}).get('pages', [])]
+        return
+    for params in queries:
+        yield list(query_pages(site, params))